@@ -0,0 +1,83 @@
+"""Compare per-worker memory with and without a preloaded embedding model.
+
+"spawn" starts every worker as a fresh interpreter that loads its own copy of the model,
+which is what `uvicorn --workers N` does. "fork" loads the model once in the parent and
+forks the workers, which is what gunicorn.conf.py does. Each worker runs one encode and
+then reports its PSS (shared pages split between the processes sharing them) and USS
+(pages private to it). Linux only.
+
+    python bench_worker_memory.py --workers 4
+"""
+import argparse
+import multiprocessing as mp
+import os
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+
+_model = None
+
+def _memory_kb(pid: int) -> dict:
+    stats = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if parts[0] in ("Rss:", "Pss:", "Private_Clean:", "Private_Dirty:"):
+                stats[parts[0][:-1]] = int(parts[1])
+    return {
+        "rss": stats["Rss"],
+        "pss": stats["Pss"],
+        "uss": stats["Private_Clean"] + stats["Private_Dirty"],
+    }
+
+def _load_model():
+    global _model
+    if _model is None:
+        from sentence_transformers import SentenceTransformer
+        _model = SentenceTransformer(MODEL_NAME)
+    return _model
+
+def _worker(ready, done):
+    _load_model().encode("warm up the encoder")
+    ready.set()
+    # Stay alive until every worker is measured so shared pages are counted correctly
+    done.wait()
+
+def run(mode: str, workers: int) -> list[dict]:
+    ctx = mp.get_context(mode)
+    if mode == "fork":
+        _load_model()
+    done = ctx.Event()
+    procs = []
+    for _ in range(workers):
+        ready = ctx.Event()
+        proc = ctx.Process(target=_worker, args=(ready, done))
+        proc.start()
+        procs.append((proc, ready))
+    for _, ready in procs:
+        ready.wait()
+    measurements = [_memory_kb(proc.pid) for proc, _ in procs]
+    parent = _memory_kb(os.getpid())
+    done.set()
+    for proc, _ in procs:
+        proc.join()
+    return measurements, parent
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--mode", choices=["spawn", "fork", "both"], default="both")
+    args = parser.parse_args()
+
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    # spawn first: once the parent has loaded the model, forked workers would inherit it
+    modes = ["spawn", "fork"] if args.mode == "both" else [args.mode]
+    print(f"{'mode':<6} {'workers':>7} {'rss/worker':>11} {'pss/worker':>11} {'uss/worker':>11} {'pss total':>10}")
+    for mode in modes:
+        measurements, parent = run(mode, args.workers)
+        avg = {k: sum(m[k] for m in measurements) / len(measurements) / 1024 for k in ("rss", "pss", "uss")}
+        # The parent's share counts too: under fork it holds part of the model pages
+        total_pss = (sum(m["pss"] for m in measurements) + parent["pss"]) / 1024
+        print(f"{mode:<6} {args.workers:>7} {avg['rss']:>9.0f}MB {avg['pss']:>9.0f}MB {avg['uss']:>9.0f}MB {total_pss:>8.0f}MB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import os
+import re
+import numpy as np
+
+# Context assembly limits
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 1500))
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", 12))
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", 0.7))
+DUPLICATE_SIMILARITY = float(os.getenv("DUPLICATE_SIMILARITY", 0.95))
+MIN_TRIMMED_TOKENS = 40
+
+# Gemini has no local tokenizer; ~4 characters per token is its documented rule of thumb
+CHARS_PER_TOKEN = 4
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+def count_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+def trim_to_sentences(text: str, max_tokens: int) -> str:
+    # Keep whole sentences while they fit; returns "" if not even the first one does
+    kept = []
+    used = 0
+    for sentence in SENTENCE_END.split(text.strip()):
+        cost = count_tokens(sentence) + (1 if kept else 0)
+        if used + cost > max_tokens:
+            break
+        kept.append(sentence)
+        used += cost
+    return " ".join(kept)
+
+def mmr_order(relevance: list[float], embeddings: list[list[float]], lambda_: float = MMR_LAMBDA) -> list[int]:
+    """Order candidates by maximal marginal relevance, dropping near-duplicates of already chosen chunks."""
+    if not relevance:
+        return []
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms == 0, 1, norms)
+    similarity = vectors @ vectors.T
+    relevance = np.asarray(relevance, dtype=np.float32)
+
+    selected = []
+    remaining = list(range(len(relevance)))
+    while remaining:
+        if selected:
+            redundancy = similarity[np.ix_(remaining, selected)].max(axis=1)
+        else:
+            redundancy = np.zeros(len(remaining), dtype=np.float32)
+        scores = lambda_ * relevance[remaining] - (1 - lambda_) * redundancy
+        best = int(np.argmax(scores))
+        index = remaining.pop(best)
+        if redundancy[best] >= DUPLICATE_SIMILARITY:
+            continue
+        selected.append(index)
+    return selected
+
+def pack_context(results: dict, budget: int = CONTEXT_TOKEN_BUDGET) -> dict:
+    """Pack the most relevant, least redundant retrieved chunks into a token budget.
+
+    `results` is the output of `RAGEngine.query(..., with_embeddings=True)`.
+    """
+    documents = results["documents"][0]
+    metadatas = results["metadatas"][0]
+    relevance = [1 - d for d in results["distances"][0]]
+    order = mmr_order(relevance, results["embeddings"][0]) if documents else []
+
+    chunks = []
+    sources = []
+    used = 0
+    for index in order:
+        text = documents[index]
+        cost = count_tokens(text)
+        if used + cost > budget:
+            # Fill what is left with the leading sentences of this chunk, then stop
+            remaining = budget - used
+            text = trim_to_sentences(text, remaining) if remaining >= MIN_TRIMMED_TOKENS else ""
+            if text:
+                chunks.append(text)
+                sources.append((metadatas[index] or {}).get("source"))
+                used += count_tokens(text)
+            break
+        chunks.append(text)
+        sources.append((metadatas[index] or {}).get("source"))
+        used += cost
+
+    return {"chunks": chunks, "sources": sources, "tokens": used}
@@ -0,0 +1,121 @@
+import os
+import re
+import threading
+import time
+import urllib.parse
+from collections import deque
+import psycopg2
+
+# Every connection starts with this statement timeout; hot reads pass a tighter one per statement
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 15000))
+DB_SEARCH_TIMEOUT_MS = int(os.getenv("DB_SEARCH_TIMEOUT_MS", 5000))
+DB_READ_RETRIES = int(os.getenv("DB_READ_RETRIES", 2))
+DB_RETRY_BACKOFF_SECONDS = float(os.getenv("DB_RETRY_BACKOFF_SECONDS", 0.1))
+# Transaction-mode poolers (e.g. PgBouncer) do not keep prepared statements between transactions
+DB_PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "true").lower() == "true"
+
+QUERY_CANCELED = "57014"
+PREPARED_STATEMENT_MISSING = "26000"
+DUPLICATE_PREPARED_STATEMENT = "42P05"
+# Worth retrying as-is: serialization failure, deadlock, server shutting down or starting up,
+# too many connections. Class 08 (connection exceptions) is matched by prefix.
+TRANSIENT_SQLSTATES = {"40001", "40P01", "57P01", "57P02", "57P03", "53300"}
+
+LATENCY_SAMPLES = 512
+
+def connect(db_url: str):
+    # Every session starts with a statement timeout so a slow scan cannot hold a connection indefinitely
+    options = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+    try:
+        return psycopg2.connect(db_url, options=options)
+    except Exception as e:
+        print(f"Direct connection failed: {e}, attempting manual parsing...")
+        url = urllib.parse.urlparse(db_url)
+        return psycopg2.connect(
+            dbname=url.path[1:],
+            user=url.username,
+            password=url.password,
+            host=url.hostname,
+            port=url.port,
+            sslmode='require',
+            options=options
+        )
+
+def is_transient(error: Exception) -> bool:
+    """Whether a failed idempotent statement may succeed if simply run again."""
+    code = getattr(error, "pgcode", None)
+    if code == QUERY_CANCELED:
+        # A statement timeout: running the same slow scan again would only repeat it
+        return False
+    if code is not None:
+        return code in TRANSIENT_SQLSTATES or code.startswith("08") or code == PREPARED_STATEMENT_MISSING
+    # No SQLSTATE: the connection itself broke (server closed it, network dropped)
+    return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+def needs_reconnect(conn, error: Exception) -> bool:
+    code = getattr(error, "pgcode", None)
+    return bool(conn.closed) or code is None or code.startswith("08") or code in ("57P01", "57P02", "57P03")
+
+def positional(sql: str, params: tuple):
+    """Rewrite $n placeholders to %s, repeating parameters that are referenced more than once."""
+    ordered = []
+    def substitute(match):
+        ordered.append(params[int(match.group(1)) - 1])
+        return "%s"
+    return re.sub(r"\$(\d+)", substitute, sql), tuple(ordered)
+
+def _percentile(ordered: list, fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class StatementStats:
+    """Per-statement call, error and retry counters with a window of recent latencies."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _entry(self, name: str) -> dict:
+        entry = self._stats.get(name)
+        if entry is None:
+            entry = self._stats[name] = {
+                "calls": 0, "errors": 0, "timeouts": 0, "retries": 0,
+                "total_ms": 0.0, "max_ms": 0.0, "recent": deque(maxlen=LATENCY_SAMPLES)
+            }
+        return entry
+
+    def record(self, name: str, seconds: float, error: Exception = None):
+        ms = seconds * 1000
+        with self._lock:
+            entry = self._entry(name)
+            entry["calls"] += 1
+            entry["total_ms"] += ms
+            entry["max_ms"] = max(entry["max_ms"], ms)
+            entry["recent"].append(ms)
+            if error is not None:
+                entry["errors"] += 1
+                if getattr(error, "pgcode", None) == QUERY_CANCELED:
+                    entry["timeouts"] += 1
+
+    def record_retry(self, name: str):
+        with self._lock:
+            self._entry(name)["retries"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            snapshot = {}
+            for name, entry in self._stats.items():
+                recent = sorted(entry["recent"])
+                snapshot[name] = {
+                    "calls": entry["calls"],
+                    "errors": entry["errors"],
+                    "timeouts": entry["timeouts"],
+                    "retries": entry["retries"],
+                    "avg_ms": round(entry["total_ms"] / entry["calls"], 2) if entry["calls"] else None,
+                    "p50_ms": round(_percentile(recent, 0.5), 2) if recent else None,
+                    "p95_ms": round(_percentile(recent, 0.95), 2) if recent else None,
+                    "max_ms": round(entry["max_ms"], 2),
+                }
+            return snapshot
+
+def backoff(attempt: int):
+    time.sleep(DB_RETRY_BACKOFF_SECONDS * (2 ** attempt))
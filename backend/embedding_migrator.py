@@ -0,0 +1,169 @@
+"""Re-embed the document corpus with another embedding model, in resumable batches.
+
+The server keeps querying and ingesting with the active model while this runs. Progress
+is stored in embedding_models, so an interrupted run picks up where it stopped. Once every
+chunk has an embedding for the target model the migration is marked complete, and servers
+started with EMBEDDING_MODEL=<target> switch to it. A server refuses to switch while any
+chunk still lacks the target's embedding (e.g. ingested after completion), so run the
+migrator once more right before restarting. Servers started without EMBEDDING_MODEL keep
+whichever model is active.
+
+    python embedding_migrator.py --model bge-small-en-v1.5 --batch-size 256
+"""
+import argparse
+import os
+import time
+from contextlib import contextmanager
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+from db import connect
+from embedding_models import EMBEDDING_MODELS
+
+class Database:
+    """The connection handling the migrator needs, without the server engine's model or start-up work."""
+
+    def __init__(self, db_url: str):
+        self.db_url = db_url
+        self.conn = connect(db_url)
+        self.conn.autocommit = True
+
+    @contextmanager
+    def transaction(self):
+        conn = connect(self.db_url)
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    yield cur
+        finally:
+            conn.close()
+
+class EmbeddingMigrator:
+    def __init__(self, engine, model_id: str, batch_size: int = 256, model=None):
+        if model_id not in EMBEDDING_MODELS:
+            raise ValueError(f"Unknown embedding model '{model_id}', expected one of {sorted(EMBEDDING_MODELS)}")
+        self.engine = engine
+        self.model_id = model_id
+        self.column = EMBEDDING_MODELS[model_id]["column"]
+        self.batch_size = batch_size
+        self._model = model
+
+    @property
+    def model(self):
+        # Loaded on first use so --status does not pay for it
+        if self._model is None:
+            from sentence_transformers import SentenceTransformer
+            self._model = SentenceTransformer(EMBEDDING_MODELS[self.model_id]["name"])
+        return self._model
+
+    def progress(self) -> dict:
+        with self.engine.conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT count(*), count({self.column})
+                FROM documents
+            """)
+            total, embedded = cur.fetchone()
+            cur.execute("""
+                SELECT migrated_through, processed, started_at, completed_at
+                FROM embedding_models
+                WHERE model_id = %s
+            """, (self.model_id,))
+            migrated_through, processed, started_at, completed_at = cur.fetchone()
+        return {
+            "model": self.model_id,
+            "total": total,
+            "embedded": embedded,
+            "migrated_through": migrated_through,
+            "processed": processed,
+            "started_at": started_at.isoformat() if started_at else None,
+            "completed_at": completed_at.isoformat() if completed_at else None,
+        }
+
+    def run(self, max_batches: int = None, report_every: int = 10) -> dict:
+        with self.engine.conn.cursor() as cur:
+            cur.execute("""
+                UPDATE embedding_models
+                SET started_at = coalesce(started_at, CURRENT_TIMESTAMP), completed_at = NULL
+                WHERE model_id = %s
+                RETURNING migrated_through
+            """, (self.model_id,))
+            last_id = cur.fetchone()[0]
+
+        started = time.monotonic()
+        done = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            with self.engine.conn.cursor() as cur:
+                cur.execute(f"""
+                    SELECT id, content
+                    FROM documents
+                    WHERE id > %s AND {self.column} IS NULL
+                    ORDER BY id
+                    LIMIT %s
+                """, (last_id, self.batch_size))
+                rows = cur.fetchall()
+            if not rows:
+                if last_id == 0:
+                    break
+                # Rows ingested behind the cursor since the last pass; sweep once more from the start
+                last_id = 0
+                continue
+
+            embeddings = self.model.encode([content or "" for _, content in rows]).tolist()
+            last_id = rows[-1][0]
+            with self.engine.transaction() as cur:
+                execute_values(cur, f"""
+                    UPDATE documents AS d SET {self.column} = v.embedding::vector
+                    FROM (VALUES %s) AS v(id, embedding)
+                    WHERE d.id = v.id
+                """, [(row_id, embedding) for (row_id, _), embedding in zip(rows, embeddings)])
+                cur.execute("""
+                    UPDATE embedding_models
+                    SET migrated_through = %s, processed = processed + %s
+                    WHERE model_id = %s
+                """, (last_id, len(rows), self.model_id))
+
+            done += len(rows)
+            batches += 1
+            if batches % report_every == 0:
+                elapsed = time.monotonic() - started
+                print(f"[{self.model_id}] {done} chunks re-embedded through id {last_id} "
+                      f"({done / elapsed:.1f} chunks/s)")
+
+        finished = max_batches is None or batches < max_batches
+        if finished:
+            with self.engine.conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE embedding_models
+                    SET completed_at = CURRENT_TIMESTAMP, migrated_through = 0
+                    WHERE model_id = %s
+                """, (self.model_id,))
+
+        elapsed = time.monotonic() - started
+        return {
+            "model": self.model_id,
+            "processed": done,
+            "seconds": round(elapsed, 1),
+            "chunks_per_second": round(done / elapsed, 1) if elapsed else None,
+            "completed": finished,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-embed all documents with another embedding model")
+    parser.add_argument("--model", required=True, choices=sorted(EMBEDDING_MODELS))
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--max-batches", type=int, default=None, help="Stop after this many batches (resume later)")
+    parser.add_argument("--status", action="store_true", help="Only print progress")
+    args = parser.parse_args()
+
+    load_dotenv()
+    db_url = os.getenv("DATABASE_URL")
+    if not db_url:
+        raise SystemExit("DATABASE_URL environment variable is not set")
+    # Only the target model is loaded, and only when there is something to re-embed
+    migrator = EmbeddingMigrator(Database(db_url), args.model, batch_size=args.batch_size)
+    if not args.status:
+        print(migrator.run(max_batches=args.max_batches))
+    print(migrator.progress())
+
+if __name__ == "__main__":
+    main()
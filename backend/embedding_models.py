@@ -0,0 +1,8 @@
+# Supported embedding models: each gets its own vector column on documents.
+# The original model keeps the legacy "embedding" column.
+EMBEDDING_MODELS = {
+    "all-MiniLM-L6-v2": {"name": "all-MiniLM-L6-v2", "column": "embedding", "dim": 384},
+    "bge-small-en-v1.5": {"name": "BAAI/bge-small-en-v1.5", "column": "embedding_bge_small", "dim": 384},
+    "all-mpnet-base-v2": {"name": "all-mpnet-base-v2", "column": "embedding_mpnet", "dim": 768},
+}
+DEFAULT_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
@@ -0,0 +1,43 @@
+# Production server: gunicorn managing uvicorn workers.
+#
+# The app (and with it the embedding model) is imported once in the master and the
+# workers are forked from it, so the model weights are shared copy-on-write instead
+# of being loaded again in every worker. Run with:
+#
+#     gunicorn -c gunicorn.conf.py main:app
+import gc
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '7860')}"
+# One worker by default: the admission gates (MAX_CONCURRENT_LLM_CALLS, MAX_CONCURRENT_INGESTS)
+# are per process, so with N workers the global caps are N times their configured values
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+
+# Recycle workers gracefully after a number of requests to cap slow memory growth;
+# jitter keeps them from all restarting at once
+max_requests = int(os.getenv("MAX_REQUESTS", 1000))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", 100))
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+timeout = int(os.getenv("WORKER_TIMEOUT", 120))
+
+# Tokenizer thread pools do not survive fork
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+# In-memory buckets are per process too; share them through Postgres unless told otherwise,
+# so per-user rate limits hold across workers
+if workers > 1:
+    os.environ.setdefault("RATE_LIMIT_BACKEND", "postgres")
+
+def when_ready(server):
+    # The master never serves requests: drop its DB connection so no socket is shared
+    # with the workers, and move everything loaded so far out of the GC's reach so
+    # collections in the workers do not touch (and un-share) those pages
+    from rag_engine import rag_engine
+    rag_engine.conn.close()
+    gc.freeze()
+
+def post_fork(server, worker):
+    from rag_engine import rag_engine
+    rag_engine.reconnect()
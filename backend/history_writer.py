@@ -0,0 +1,102 @@
+import os
+import queue
+import threading
+import time
+
+# Write-behind settings for chat history
+HISTORY_QUEUE_SIZE = int(os.getenv("HISTORY_QUEUE_SIZE", 10000))
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", 100))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", 1.0))
+
+# Queued by stop() to wake a collector blocked on an empty queue
+_WAKE = object()
+
+class HistoryWriter:
+    """Buffers chat history rows in memory and inserts them in multi-row batches from a background thread.
+
+    Rows are flushed when a batch fills up or `flush_interval` seconds after the first
+    queued row, whichever comes first. When the queue is full new rows are dropped and counted.
+    """
+
+    def __init__(self, engine, max_queue: int = HISTORY_QUEUE_SIZE, batch_size: int = HISTORY_BATCH_SIZE,
+                 flush_interval: float = HISTORY_FLUSH_INTERVAL):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counters = {"enqueued": 0, "written": 0, "dropped": 0, "failed": 0, "flushes": 0}
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        # Drain whatever is still queued before returning
+        self._stopping.set()
+        try:
+            self.queue.put_nowait(_WAKE)
+        except queue.Full:
+            pass
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def enqueue(self, user_message: str, ai_message: str, user_id: int) -> bool:
+        try:
+            self.queue.put_nowait((user_message, ai_message, user_id))
+        except queue.Full:
+            self._count("dropped")
+            print("History queue full, dropping chat write")
+            return False
+        self._count("enqueued")
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"queue_depth": self.queue.qsize(), **self._counters}
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def _run(self):
+        while not (self._stopping.is_set() and self.queue.empty()):
+            batch = self._collect()
+            if batch:
+                self._flush(batch)
+
+    def _collect(self) -> list:
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            if deadline is None:
+                timeout = self.flush_interval
+            else:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+            if self._stopping.is_set():
+                timeout = 0
+            try:
+                item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _WAKE:
+                continue
+            batch.append(item)
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+        return batch
+
+    def _flush(self, batch: list):
+        try:
+            self.engine.save_chats(batch)
+            self._count("written", len(batch))
+        except Exception as e:
+            self._count("failed", len(batch))
+            print(f"History flush failed ({len(batch)} rows): {e}")
+        self._count("flushes")
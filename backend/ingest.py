@@ -1,39 +1,74 @@
 from PIL import Image
 import pytesseract
 import io
-import tempfile
 import os
-from langchain_community.document_loaders import PyPDFLoader
+from typing import BinaryIO, Optional, Union
+from pypdf import PdfReader
 
-def extract_text_from_image(image_bytes: bytes) -> list[dict]:
+from starlette.formparsers import MultiPartParser
+from starlette.datastructures import UploadFile
+
+# Upload limits (bytes)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 25 * 1024 * 1024))
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", 1024 * 1024))
+
+class UploadTooLarge(Exception):
+    pass
+
+async def read_upload(request, field: str = "file", max_bytes: Optional[int] = None) -> UploadFile:
+    """Parse a multipart upload straight off the request stream, stopping once it passes `max_bytes`.
+
+    The file is spooled exactly once, by the multipart parser: in memory up to
+    UPLOAD_SPOOL_BYTES, then on disk. Nothing is read until the caller asks, so a caller
+    holding an admission slot bounds how many bodies are buffered at a time. The cap
+    also holds for requests without a Content-Length.
+    """
+    max_bytes = max_bytes or MAX_UPLOAD_BYTES
+
+    async def capped_stream():
+        total = 0
+        async for chunk in request.stream():
+            total += len(chunk)
+            if total > max_bytes:
+                raise UploadTooLarge(f"File exceeds the {max_bytes // (1024 * 1024)} MB upload limit")
+            yield chunk
+
+    parser = MultiPartParser(request.headers, capped_stream(), max_files=1, max_fields=10)
+    parser.spool_max_size = UPLOAD_SPOOL_BYTES
+    # The parser closes its temporary files itself if the stream fails
+    form = await parser.parse()
+    upload = form.get(field)
+    if not isinstance(upload, UploadFile):
+        await form.close()
+        raise ValueError(f"Expected a file in the '{field}' form field")
+    return upload
+
+def _as_stream(data: Union[bytes, BinaryIO]) -> BinaryIO:
+    return io.BytesIO(data) if isinstance(data, (bytes, bytearray)) else data
+
+def extract_text_from_image(image: Union[bytes, BinaryIO]) -> list[dict]:
     try:
-        image = Image.open(io.BytesIO(image_bytes))
+        image = Image.open(_as_stream(image))
         text = pytesseract.image_to_string(image)
         return [{"text": text, "metadata": {"page": 1}}]
     except Exception as e:
         print(f"Error extracting text from image: {e}")
         return []
 
-def extract_text_from_pdf(pdf_bytes: bytes) -> list[dict]:
+def extract_text_from_pdf(pdf: Union[bytes, BinaryIO]) -> list[dict]:
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-            tmp_file.write(pdf_bytes)
-            tmp_path = tmp_file.name
-        
-        loader = PyPDFLoader(tmp_path)
-        pages = loader.load()
-        
+        # Read pages straight from the uploaded file instead of copying it first
+        reader = PdfReader(_as_stream(pdf))
+
         # Return list of chunks with page numbers
         result = []
-        for page in pages:
+        for index, page in enumerate(reader.pages):
             result.append({
-                "text": page.page_content,
-                "metadata": {"page": page.metadata.get("page", 0) + 1} # 1-based indexing
+                "text": page.extract_text() or "",
+                "metadata": {"page": index + 1} # 1-based indexing
             })
-        
-        os.remove(tmp_path)
+
         return result
     except Exception as e:
         print(f"Error extracting text from PDF: {e}")
         return []
-
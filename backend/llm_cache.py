@@ -0,0 +1,93 @@
+import os
+import hashlib
+import threading
+import datetime
+from collections import OrderedDict
+import google.generativeai as genai
+from google.generativeai import caching
+from context import count_tokens
+
+# Gemini only caches contents above a model-dependent minimum size
+GEMINI_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CACHE_MIN_TOKENS", 1024))
+GEMINI_CACHE_TTL_SECONDS = int(os.getenv("GEMINI_CACHE_TTL_SECONDS", 3600))
+
+# Models clients may request (the frontend's model picker); anything else is rejected
+GEMINI_MODELS = [m for m in os.getenv(
+    "GEMINI_MODELS",
+    "gemini-2.5-pro,gemini-2.5-flash,gemini-2.5-flash-lite,gemini-2.0-flash,gemini-1.5-pro,gemini-1.5-flash"
+).split(",") if m]
+# Most (model, instruction) pairs kept; the least recently used is dropped beyond this
+MODEL_CACHE_SIZE = int(os.getenv("MODEL_CACHE_SIZE", 64))
+
+class UnknownModel(ValueError):
+    def __init__(self, model_name: str):
+        super().__init__(f"Unknown model '{model_name}', expected one of {GEMINI_MODELS}")
+
+class ModelCache:
+    """Hands out GenerativeModels bound to a static system instruction.
+
+    Large instructions are uploaded once as Gemini cached content, so each call is billed
+    only for the dynamic part of the prompt. Instructions under the provider minimum, or a
+    failed cache creation, fall back to a plain `system_instruction`.
+    """
+
+    def __init__(self, max_entries: int = MODEL_CACHE_SIZE):
+        self._models = OrderedDict()
+        self._building = {}
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+        self.stats = {"cached": 0, "uncached": 0, "cache_errors": 0}
+
+    def get(self, model_name: str, system_instruction: str):
+        """May create a provider cache (a network call); call it from a worker thread, not the event loop."""
+        if model_name not in GEMINI_MODELS:
+            raise UnknownModel(model_name)
+        key = (model_name, hashlib.sha256(system_instruction.encode("utf-8")).hexdigest())
+        with self._lock:
+            model = self._lookup(key)
+            if model:
+                return model
+            building = self._building.setdefault(key, threading.Lock())
+        
+        # Only callers wanting this same entry wait on the build; the cache itself stays available
+        with building:
+            with self._lock:
+                model = self._lookup(key)
+                if model:
+                    return model
+            now = datetime.datetime.now(datetime.timezone.utc)
+            model, expires = self._build(model_name, system_instruction, now)
+            with self._lock:
+                self._models[key] = {"model": model, "expires": expires}
+                self._models.move_to_end(key)
+                while len(self._models) > self.max_entries:
+                    self._models.popitem(last=False)
+                self._building.pop(key, None)
+            return model
+
+    def _lookup(self, key):
+        entry = self._models.get(key)
+        if entry and (entry["expires"] is None or entry["expires"] > datetime.datetime.now(datetime.timezone.utc)):
+            self._models.move_to_end(key)
+            return entry["model"]
+        return None
+
+    def _build(self, model_name: str, system_instruction: str, now):
+        if count_tokens(system_instruction) >= GEMINI_CACHE_MIN_TOKENS:
+            try:
+                ttl = datetime.timedelta(seconds=GEMINI_CACHE_TTL_SECONDS)
+                cached = caching.CachedContent.create(
+                    model=f"models/{model_name}",
+                    system_instruction=system_instruction,
+                    ttl=ttl
+                )
+                self.stats["cached"] += 1
+                # Rebuild a little before the provider drops the cache
+                return genai.GenerativeModel.from_cached_content(cached), now + ttl * 0.9
+            except Exception as e:
+                self.stats["cache_errors"] += 1
+                print(f"Context cache unavailable for {model_name}: {e}")
+        self.stats["uncached"] += 1
+        return genai.GenerativeModel(model_name, system_instruction=system_instruction), None
+
+model_cache = ModelCache()
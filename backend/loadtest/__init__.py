@@ -0,0 +1,5 @@
+"""Load-test harness: a mixed-traffic generator and a stub Gemini server.
+
+    python -m loadtest.stub_gemini --port 8765
+    python -m loadtest --base-url http://localhost:7860 --ramp 2,4,8,16
+"""
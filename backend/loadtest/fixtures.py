@@ -0,0 +1,74 @@
+import random
+import textwrap
+
+QUERIES = [
+    "Write a prompt that summarizes our quarterly revenue report for executives",
+    "Create a prompt for extracting action items from meeting notes",
+    "How do I ask an LLM to compare two vendor contracts clause by clause?",
+    "Draft a prompt that turns support tickets into a weekly trends digest",
+    "What does the onboarding guide say about VPN access?",
+    "Build a prompt for reviewing pull requests for security issues",
+    "Prompt to generate unit test ideas from a feature specification",
+    "Summarize the key risks listed in the project charter",
+    "Create a study plan prompt based on the course syllabus",
+    "Write a prompt that rewrites release notes for non-technical users",
+]
+
+INSTRUCTIONS = [
+    "Make it shorter",
+    "Add a section on output format",
+    "Use a more formal tone",
+    "Ask for a bulleted list instead of prose",
+    "Include two worked examples",
+    "Focus on the security aspects",
+]
+
+MODES = ["engineer", "engineer", "critic", "direct"]
+
+TOPIC_WORDS = (
+    "revenue pipeline onboarding security compliance roadmap incident customer latency "
+    "budget forecast contract vendor release migration database architecture policy "
+    "training retention escalation availability backlog quarterly milestone review"
+).split()
+
+def paragraph(rng: random.Random, words: int = 120) -> str:
+    sentences = []
+    while sum(len(s.split()) for s in sentences) < words:
+        length = rng.randint(8, 18)
+        sentence = " ".join(rng.choice(TOPIC_WORDS) for _ in range(length))
+        sentences.append(sentence.capitalize() + ".")
+    return " ".join(sentences)
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def make_pdf(pages: list[str]) -> bytes:
+    """A minimal text-only PDF (Helvetica, one text block per page) that pypdf can extract."""
+    page_ids = [4 + 2 * i for i in range(len(pages))]
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{' '.join(f'{p} 0 R' for p in page_ids)}] /Count {len(pages)} >>".encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for page_id, text in zip(page_ids, pages):
+        lines = textwrap.wrap(text, 95) or [""]
+        stream = ("BT /F1 10 Tf 12 TL 50 750 Td " + " ".join(f"({_escape(line)}) '" for line in lines) + " ET").encode("latin-1", "replace")
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {page_id + 1} 0 R >>".encode()
+        )
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n".encode() + stream + b"\nendstream")
+
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += b"".join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return out
+
+def make_document(rng: random.Random, pages: int = 3) -> bytes:
+    return make_pdf([paragraph(rng) for _ in range(pages)])
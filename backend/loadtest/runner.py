@@ -0,0 +1,399 @@
+"""Drive a running backend with a mixed workload and report where it saturates.
+
+Requests arrive open-loop (Poisson arrivals at the offered rate), so a slow server
+builds a queue instead of silently slowing the generator down. Latency is measured
+from each request's scheduled start. While a stage runs, /api/metrics is sampled
+to find the stage that saturates first: the admission gates, database statements
+or the history writer.
+
+    python -m loadtest --base-url http://localhost:7860 --ramp 2,4,8,16 --duration 60
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+from collections import Counter, defaultdict
+import httpx
+from loadtest.fixtures import QUERIES, INSTRUCTIONS, MODES, make_document
+
+# "refine" is the stateless /api/refine the frontend uses; "refine_session" drives server-side sessions
+OPERATIONS = ("login", "generate", "refine", "refine_session", "ingest", "history")
+DEFAULT_MIX = "login=1,generate=4,refine=2,ingest=1,history=2"
+DEFAULT_PASSWORD = "loadtest-password"
+STARTING_PROMPT = "Write a prompt that summarizes a long technical document for a busy reader."
+
+# Where each operation spends its time on the server, for reporting a latency-only bottleneck
+OPERATION_STAGES = {
+    "login": "password hashing (CPU)",
+    "generate": "retrieval (embedding + vector search)",
+    "refine": "refinement (LLM)",
+    "refine_session": "refinement sessions (database + LLM)",
+    "ingest": "ingest (PDF parsing + embedding)",
+    "history": "history reads (database)",
+}
+
+def parse_mix(spec: str) -> dict:
+    """Parse "generate=4,history=2" into operation weights."""
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation '{name}', expected one of {OPERATIONS}")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("The traffic mix needs at least one operation with a positive weight")
+    return mix
+
+def percentile(ordered: list, fraction: float):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def classify(response: httpx.Response) -> str:
+    if response.status_code == 429:
+        # Both admission control and rate limits answer 429; only the message tells them apart
+        try:
+            detail = response.json().get("detail", "")
+        except ValueError:
+            detail = ""
+        return "overloaded" if "at capacity" in detail else "rate_limited"
+    if response.status_code >= 400:
+        return f"http_{response.status_code}"
+    try:
+        body = response.json()
+    except ValueError:
+        return "ok"
+    # Some handlers report LLM and extraction failures in a 200 body
+    if isinstance(body, dict) and (
+        body.get("error") is True
+        or str(body.get("response", "")).startswith("Error generating")
+        or "encountered an error" in str(body.get("ai_response", ""))
+    ):
+        return "app_error"
+    return "ok"
+
+class VirtualUser:
+    def __init__(self, email: str):
+        self.email = email
+        self.token = None
+        self.session_id = None
+        # Client-side refinement state, as the frontend keeps it
+        self.prompt = STARTING_PROMPT
+        self.chat_history = []
+
+    @property
+    def headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.token}"}
+
+class Recorder:
+    def __init__(self):
+        self.outcomes = defaultdict(Counter)
+        self.latencies = defaultdict(list)
+
+    def record(self, operation: str, outcome: str, seconds: float):
+        self.outcomes[operation][outcome] += 1
+        if outcome == "ok":
+            self.latencies[operation].append(seconds)
+
+    def summary(self, elapsed: float) -> dict:
+        def describe(outcomes: Counter, latencies: list) -> dict:
+            sent = sum(outcomes.values())
+            ordered = sorted(latencies)
+            return {
+                "sent": sent,
+                "ok": outcomes["ok"],
+                "error_rate": round(1 - outcomes["ok"] / sent, 4) if sent else 0.0,
+                "errors": {k: v for k, v in outcomes.items() if k != "ok"},
+                "ok_per_second": round(outcomes["ok"] / elapsed, 2) if elapsed else None,
+                "p50_ms": round(percentile(ordered, 0.50) * 1000, 1) if ordered else None,
+                "p95_ms": round(percentile(ordered, 0.95) * 1000, 1) if ordered else None,
+                "p99_ms": round(percentile(ordered, 0.99) * 1000, 1) if ordered else None,
+            }
+
+        summary = {op: describe(self.outcomes[op], self.latencies[op]) for op in OPERATIONS if self.outcomes[op]}
+        total = sum(self.outcomes.values(), Counter())
+        summary["total"] = describe(total, [s for op in OPERATIONS for s in self.latencies[op]])
+        return summary
+
+class Workload:
+    def __init__(self, client: httpx.AsyncClient, users: list, mix: dict, password: str, rng: random.Random):
+        self.client = client
+        self.users = users
+        self.password = password
+        self.rng = rng
+        self.operations = list(mix)
+        self.weights = [mix[op] for op in self.operations]
+
+    def pick(self) -> str:
+        return self.rng.choices(self.operations, self.weights)[0]
+
+    async def run(self, operation: str, recorder: Recorder, scheduled: float):
+        loop = asyncio.get_running_loop()
+        user = self.rng.choice(self.users)
+        try:
+            outcome = classify(await getattr(self, operation)(user))
+        except httpx.TimeoutException:
+            outcome = "timeout"
+        except httpx.TransportError:
+            outcome = "connection_error"
+        recorder.record(operation, outcome, loop.time() - scheduled)
+
+    async def login(self, user: VirtualUser) -> httpx.Response:
+        response = await self.client.post("/api/login", json={"email": user.email, "password": self.password})
+        if response.status_code == 200:
+            user.token = response.json()["access_token"]
+        return response
+
+    async def generate(self, user: VirtualUser) -> httpx.Response:
+        return await self.client.post("/api/generate", headers=user.headers, json={
+            "query": self.rng.choice(QUERIES),
+            "mode": self.rng.choice(MODES)
+        })
+
+    async def refine(self, user: VirtualUser) -> httpx.Response:
+        instruction = self.rng.choice(INSTRUCTIONS)
+        history = user.chat_history[-8:] + [{"role": "user", "content": instruction}]
+        response = await self.client.post("/api/refine", headers=user.headers, json={
+            "current_prompt": user.prompt,
+            "instruction": instruction,
+            "chat_history": history
+        })
+        if classify(response) == "ok":
+            body = response.json()
+            user.prompt = body.get("refined_prompt") or user.prompt
+            user.chat_history = history + [{"role": "ai", "content": body.get("ai_response", "")}]
+        return response
+
+    async def refine_session(self, user: VirtualUser) -> httpx.Response:
+        return await self.client.post(
+            f"/api/refine/sessions/{user.session_id}/turns",
+            headers=user.headers,
+            json={"instruction": self.rng.choice(INSTRUCTIONS)}
+        )
+
+    async def ingest(self, user: VirtualUser) -> httpx.Response:
+        # A few file names per user, so re-uploads exercise the incremental sync path too
+        name = f"loadtest-{self.rng.randrange(4)}.pdf"
+        document = make_document(self.rng, pages=self.rng.randint(1, 4))
+        return await self.client.post(
+            "/api/ingest/file",
+            headers=user.headers,
+            files={"file": (name, document, "application/pdf")}
+        )
+
+    async def history(self, user: VirtualUser) -> httpx.Response:
+        return await self.client.get("/api/history", headers=user.headers, params={"limit": 20, "preview": "true"})
+
+async def prepare_users(client: httpx.AsyncClient, count: int, password: str, prefix: str, open_sessions: bool = True) -> list:
+    """Register (or reuse) the virtual users, log them in and, if asked, open a refinement session for each."""
+    slots = asyncio.Semaphore(8)
+
+    async def prepare(index: int) -> VirtualUser:
+        user = VirtualUser(f"{prefix}-{index}@example.com")
+        async with slots:
+            # 400 means the user exists from an earlier run
+            response = await client.post("/api/register", json={"email": user.email, "password": password})
+            if response.status_code not in (200, 400):
+                raise RuntimeError(f"Registering {user.email} failed: {response.status_code} {response.text}")
+            response = await client.post("/api/login", json={"email": user.email, "password": password})
+            if response.status_code != 200:
+                raise RuntimeError(f"Logging in {user.email} failed: {response.status_code} {response.text}")
+            user.token = response.json()["access_token"]
+            if not open_sessions:
+                return user
+            response = await client.post("/api/refine/sessions", headers=user.headers, json={"prompt": STARTING_PROMPT})
+            if response.status_code != 200:
+                raise RuntimeError(f"Opening a refinement session failed: {response.status_code} {response.text}")
+            user.session_id = response.json()["id"]
+        return user
+
+    return await asyncio.gather(*(prepare(i) for i in range(count)))
+
+async def sample_metrics(client: httpx.AsyncClient, interval: float, samples: list, stop: asyncio.Event, token: str = None):
+    headers = {"X-Metrics-Token": token} if token else {}
+    warned = False
+    while True:
+        try:
+            response = await client.get("/api/metrics", headers=headers)
+            if response.status_code == 200:
+                samples.append(response.json())
+            elif not warned:
+                warned = True
+                print(f"/api/metrics answered {response.status_code}; start the server with METRICS_TOKEN "
+                      f"and pass the same value with --metrics-token to find the saturating stage")
+        except httpx.HTTPError:
+            pass
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+            return
+        except asyncio.TimeoutError:
+            continue
+
+async def run_stage(workload: Workload, rate: float, duration: float, max_in_flight: int, metrics_interval: float,
+                    metrics_token: str = None) -> dict:
+    loop = asyncio.get_running_loop()
+    recorder = Recorder()
+    samples = []
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_metrics(workload.client, metrics_interval, samples, stop, metrics_token))
+    in_flight = set()
+
+    started = loop.time()
+    next_at = started
+    while True:
+        next_at += workload.rng.expovariate(rate)
+        if next_at >= started + duration:
+            break
+        await asyncio.sleep(max(0.0, next_at - loop.time()))
+        operation = workload.pick()
+        if len(in_flight) >= max_in_flight:
+            recorder.record(operation, "dropped", 0.0)
+            continue
+        task = asyncio.create_task(workload.run(operation, recorder, scheduled=next_at))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+    if in_flight:
+        await asyncio.gather(*in_flight)
+    elapsed = loop.time() - started
+
+    stop.set()
+    await sampler
+    return {
+        "offered_rps": rate,
+        "duration": duration,
+        "elapsed": round(elapsed, 1),
+        "operations": recorder.summary(elapsed),
+        "metrics": samples,
+    }
+
+def _delta(before: dict, after: dict, *path):
+    for key in path:
+        before = (before or {}).get(key)
+        after = (after or {}).get(key)
+    if after is None:
+        return 0
+    return after - (before or 0)
+
+def find_bottleneck(stage: dict, baseline: dict = None, db_p95_ms: float = 250) -> dict:
+    """Name the stage that saturated first, with the signals that point to it.
+
+    Server-side signals come first, in the order work flows through a request: admission
+    gates, database statements, the history writer. Otherwise the operation whose p95
+    grew most against the baseline stage is named.
+    """
+    samples = stage["metrics"]
+    signals = []
+    if samples:
+        before, after = samples[0], samples[-1]
+        for gate in ("llm", "ingest"):
+            rejected = _delta(before, after, "admission", gate, "rejected")
+            peak_waiting = max(s.get("admission", {}).get(gate, {}).get("waiting", 0) for s in samples)
+            if rejected or peak_waiting:
+                signals.append((f"{gate} admission gate", f"{rejected} rejected, up to {peak_waiting} queued for a slot"))
+
+        slow = []
+        for name, stats in (after.get("db") or {}).items():
+            timeouts = _delta(before, after, "db", name, "timeouts")
+            if timeouts or (stats.get("p95_ms") or 0) > db_p95_ms:
+                slow.append(f"{name} p95 {stats.get('p95_ms')} ms, {timeouts} timeouts")
+        if slow:
+            signals.append(("database", "; ".join(slow)))
+
+        depths = [s.get("history_writer", {}).get("queue_depth", 0) for s in samples]
+        dropped = _delta(before, after, "history_writer", "dropped")
+        if dropped or (len(depths) > 2 and depths[-1] > depths[0] and max(depths) > 100):
+            signals.append(("history writer", f"queue depth {depths[0]} -> {depths[-1]}, {dropped} dropped"))
+
+    dropped_client = sum(op["errors"].get("dropped", 0) for name, op in stage["operations"].items() if name != "total")
+    if dropped_client:
+        signals.append(("load generator", f"{dropped_client} arrivals dropped at --max-in-flight; raise it or add generators"))
+
+    if not signals and baseline:
+        growth = []
+        for name, op in stage["operations"].items():
+            base = baseline["operations"].get(name, {})
+            if name != "total" and op.get("p95_ms") and base.get("p95_ms"):
+                growth.append((op["p95_ms"] / base["p95_ms"], name))
+        if growth:
+            ratio, name = max(growth)
+            if ratio >= 2:
+                signals.append((OPERATION_STAGES[name], f"{name} p95 grew {ratio:.1f}x over the baseline stage"))
+
+    return {
+        "stage": signals[0][0] if signals else None,
+        "signals": [f"{stage_name}: {detail}" for stage_name, detail in signals],
+    }
+
+def saturation_point(stages: list, max_error_rate: float = 0.01):
+    """The first offered rate the server could not keep up with, if any."""
+    for stage in stages:
+        total = stage["operations"]["total"]
+        # Compare with the arrivals actually generated, not the nominal rate; completions
+        # falling behind them means work queued up and had to drain after the stage ended
+        arrivals = total["sent"] / stage["duration"]
+        completed = total["ok"] / stage["elapsed"]
+        if total["error_rate"] > max_error_rate or completed < 0.9 * arrivals:
+            return stage["offered_rps"]
+    return None
+
+def print_stage(stage: dict):
+    total = stage["operations"]["total"]
+    print(f"\n== {stage['offered_rps']:g} req/s offered for {stage['duration']:g}s: "
+          f"{total['ok_per_second']} ok/s, {total['error_rate'] * 100:.1f}% errors ==")
+    print(f"{'operation':<14} {'sent':>6} {'ok':>6} {'err%':>6} {'ok/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  errors")
+    for name, op in stage["operations"].items():
+        cells = [op[k] if op[k] is not None else "-" for k in ("p50_ms", "p95_ms", "p99_ms")]
+        errors = ", ".join(f"{k}={v}" for k, v in sorted(op["errors"].items()))
+        print(f"{name:<14} {op['sent']:>6} {op['ok']:>6} {op['error_rate'] * 100:>6.1f} {op['ok_per_second']:>7} "
+              f"{cells[0]:>8} {cells[1]:>8} {cells[2]:>8}  {errors}")
+    bottleneck = stage["bottleneck"]
+    print(f"saturating stage: {bottleneck['stage'] or 'none detected'}")
+    for signal in bottleneck["signals"]:
+        print(f"  - {signal}")
+
+async def run(args) -> dict:
+    mix = parse_mix(args.mix)
+    rates = [float(r) for r in args.ramp.split(",")] if args.ramp else [args.rate]
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(max_connections=args.max_in_flight + 4, max_keepalive_connections=args.max_in_flight)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        users = await prepare_users(client, args.users, args.password, args.user_prefix, "refine_session" in mix)
+        workload = Workload(client, users, mix, args.password, rng)
+        print(f"Prepared {len(users)} users; mix {mix}")
+
+        stages = []
+        for rate in rates:
+            stage = await run_stage(workload, rate, args.duration, args.max_in_flight, args.metrics_interval, args.metrics_token)
+            stage["bottleneck"] = find_bottleneck(stage, stages[0] if stages else None, args.db_p95_ms)
+            stages.append(stage)
+            print_stage(stage)
+
+    point = saturation_point(stages)
+    print(f"\nsaturation point: {f'{point:g} req/s' if point else 'not reached'}")
+    return {"mix": mix, "users": args.users, "stages": stages, "saturation_rps": point}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://localhost:7860")
+    parser.add_argument("--users", type=int, default=20, help="Virtual users; rate limits apply per user")
+    parser.add_argument("--password", default=DEFAULT_PASSWORD)
+    parser.add_argument("--user-prefix", default="loadtest")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Operation weights (default {DEFAULT_MIX})")
+    parser.add_argument("--rate", type=float, default=5, help="Offered requests per second")
+    parser.add_argument("--ramp", default=None, help="Comma-separated rates, one stage each (overrides --rate)")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds per stage")
+    parser.add_argument("--max-in-flight", type=int, default=256)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--metrics-interval", type=float, default=2)
+    parser.add_argument("--metrics-token", default=os.getenv("METRICS_TOKEN"), help="The server's METRICS_TOKEN")
+    parser.add_argument("--db-p95-ms", type=float, default=250, help="Statement p95 treated as database saturation")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", default=None, help="Also write the full report, metrics samples included, here")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
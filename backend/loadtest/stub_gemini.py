@@ -0,0 +1,126 @@
+"""Stand-in for the Gemini REST API with a realistic latency profile.
+
+Answers generateContent for any model. Latency is a log-normal time to first token
+plus a per-output-token decode time, so long answers are slower and there is a tail.
+JSON-mode requests (refinement) get a well-formed refinement payload. Point the
+backend at it with GEMINI_API_ENDPOINT=http://localhost:8765.
+
+    python -m loadtest.stub_gemini --port 8765 --median-ms 600 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+from fastapi import FastAPI, Request
+from starlette.responses import JSONResponse
+
+CHARS_PER_TOKEN = 4
+
+WORDS = (
+    "role context task constraints output format audience tone examples steps verify "
+    "summarize analyze compare cite sources assumptions edge cases structure concise"
+).split()
+
+class LatencyProfile:
+    def __init__(self, median_ms: float = 600, sigma: float = 0.5, ms_per_token: float = 6,
+                 min_output_tokens: int = 120, max_output_tokens: int = 480, error_rate: float = 0.0, seed: int = None):
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.ms_per_token = ms_per_token
+        self.min_output_tokens = min_output_tokens
+        self.max_output_tokens = max_output_tokens
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+    def output_tokens(self) -> int:
+        return self.random.randint(self.min_output_tokens, self.max_output_tokens)
+
+    def seconds(self, output_tokens: int) -> float:
+        first_token = self.random.lognormvariate(math.log(self.median_ms), self.sigma)
+        return (first_token + output_tokens * self.ms_per_token) / 1000
+
+    def fails(self) -> bool:
+        return self.random.random() < self.error_rate
+
+def _text_of(content) -> str:
+    if not content:
+        return ""
+    return " ".join(part.get("text", "") for part in content.get("parts", []))
+
+def _filler(rng: random.Random, tokens: int) -> str:
+    words = []
+    while len(" ".join(words)) < tokens * CHARS_PER_TOKEN:
+        words.append(rng.choice(WORDS))
+    return " ".join(words)
+
+def create_app(profile: LatencyProfile) -> FastAPI:
+    app = FastAPI(title="Gemini stub")
+    app.state.stats = {"requests": 0, "errors": 0, "in_flight": 0, "max_in_flight": 0}
+
+    @app.post("/{version}/models/{model_action}")
+    async def generate_content(version: str, model_action: str, request: Request):
+        model, _, action = model_action.partition(":")
+        if action not in ("generateContent", "streamGenerateContent"):
+            return JSONResponse(status_code=404, content={"error": {"code": 404, "message": f"Unknown action {action}", "status": "NOT_FOUND"}})
+        body = await request.json()
+        stats = app.state.stats
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            output_tokens = profile.output_tokens()
+            await asyncio.sleep(profile.seconds(output_tokens))
+            if profile.fails():
+                stats["errors"] += 1
+                return JSONResponse(status_code=503, content={"error": {"code": 503, "message": "The model is overloaded.", "status": "UNAVAILABLE"}})
+
+            prompt = " ".join(_text_of(c) for c in body.get("contents", [])) + _text_of(body.get("systemInstruction"))
+            answer = _filler(profile.random, output_tokens)
+            config = body.get("generationConfig") or {}
+            if config.get("responseMimeType") == "application/json":
+                answer = json.dumps({
+                    "refined_prompt": answer,
+                    "ai_response": "Tightened the wording and added an output format.",
+                    "summary": "The user is iterating on a prompt and wants it shorter and more structured."
+                })
+            prompt_tokens = -(-len(prompt) // CHARS_PER_TOKEN)
+            return {
+                "candidates": [{
+                    "content": {"parts": [{"text": answer}], "role": "model"},
+                    "finishReason": "STOP",
+                    "index": 0
+                }],
+                "usageMetadata": {
+                    "promptTokenCount": prompt_tokens,
+                    "candidatesTokenCount": output_tokens,
+                    "totalTokenCount": prompt_tokens + output_tokens
+                },
+                "modelVersion": model
+            }
+        finally:
+            stats["in_flight"] -= 1
+
+    @app.get("/stats")
+    async def stub_stats():
+        return app.state.stats
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--median-ms", type=float, default=600, help="Median time to first token")
+    parser.add_argument("--sigma", type=float, default=0.5, help="Log-normal spread of time to first token")
+    parser.add_argument("--ms-per-token", type=float, default=6, help="Decode time per output token")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of calls answered with 503")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    import uvicorn
+    profile = LatencyProfile(args.median_ms, args.sigma, args.ms_per_token, error_rate=args.error_rate, seed=args.seed)
+    uvicorn.run(create_app(profile), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
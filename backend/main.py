@@ -1,30 +1,40 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, status, Request
+from fastapi import FastAPI, Form, HTTPException, Depends, Header, status, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
-from starlette.responses import RedirectResponse
+from starlette.responses import RedirectResponse, StreamingResponse, JSONResponse
 from fastapi.security import OAuth2PasswordBearer
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Optional, Dict, Literal, Union
 import uvicorn
 import os
 import asyncio
 import json
+import base64
+import secrets
+import numpy as np
 import google.generativeai as genai
 from contextlib import asynccontextmanager
 from auth import auth_handler
-from rag_engine import RAGEngine
-from ingest import extract_text_from_image, extract_text_from_pdf
+from rag_engine import rag_engine, encode_cursor
+from ingest import extract_text_from_image, extract_text_from_pdf, read_upload, UploadTooLarge, MAX_UPLOAD_BYTES
+from starlette.formparsers import MultiPartException
+from starlette.concurrency import run_in_threadpool
+from context import pack_context, count_tokens, CONTEXT_CANDIDATES
+from history_writer import HistoryWriter
+from llm_cache import model_cache, UnknownModel, GEMINI_MODELS
+from prompt_templates import prompt_registry, GENERATION_FIELDS
+from rate_limit import RateLimiter, AdmissionGate, RateLimited, Overloaded, CostExceedsLimit, create_rate_limit_store, parse_limit
 from dotenv import load_dotenv
 from authlib.integrations.starlette_client import OAuth
 
 # Load environment variables
 load_dotenv()
 
-# Initialize RAG Engine
-db_url = os.getenv("DATABASE_URL")
-if not db_url:
-    raise ValueError("DATABASE_URL environment variable is not set")
-rag_engine = RAGEngine(db_url)
+# The RAG Engine is the module-level instance from rag_engine, so each process
+# loads the embedding model once (and a preloading server loads it once in total)
+
+# Chat history is written behind the response in batches
+history_writer = HistoryWriter(rag_engine)
 
 async def keep_db_alive():
     while True:
@@ -34,19 +44,99 @@ async def keep_db_alive():
             print(f"Background keep-alive error: {e}")
         await asyncio.sleep(240)
 
+# Periodic vacuum/reindex check; deletes and re-ingests leave dead chunk rows behind
+MAINTENANCE_INTERVAL_SECONDS = int(os.getenv("MAINTENANCE_INTERVAL_SECONDS", 3600))
+
+async def maintain_db():
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL_SECONDS)
+        try:
+            await run_in_threadpool(rag_engine.maintain_documents)
+        except Exception as e:
+            print(f"Background maintenance error: {e}")
+
+# Models whose template prefixes are registered with the context cache at startup
+PROMPT_CACHE_MODELS = [m for m in os.getenv("PROMPT_CACHE_MODELS", "gemini-1.5-flash").split(",") if m]
+
+def warm_prompt_cache():
+    for model_name in PROMPT_CACHE_MODELS:
+        for template in prompt_registry.latest():
+            try:
+                model_cache.get(model_name, template.system_instruction)
+            except UnknownModel as e:
+                print(f"Skipping prompt cache warm-up: {e}")
+                break
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    task = asyncio.create_task(keep_db_alive())
+    history_writer.start()
+    await run_in_threadpool(warm_prompt_cache)
+    tasks = [asyncio.create_task(keep_db_alive()), asyncio.create_task(maintain_db())]
     yield
-    task.cancel()
-    try:
-        await task
-    except asyncio.CancelledError:
-        pass
+    for task in tasks:
+        task.cancel()
+    for task in tasks:
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    await run_in_threadpool(history_writer.stop)
 
 # Initialize FastAPI app
 app = FastAPI(title="RAG Prompt Engine", lifespan=lifespan)
 
+# Reject oversized uploads from the declared length before the multipart body is parsed
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    if request.url.path.startswith("/api/ingest/"):
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES:
+            return JSONResponse(status_code=413, content={"detail": "Upload too large"})
+    return await call_next(request)
+
+# Per-user token buckets, one per endpoint class ("<requests>/<seconds>")
+rate_limiter = RateLimiter(create_rate_limit_store(rag_engine), {
+    "generate": parse_limit(os.getenv("RATE_LIMIT_GENERATE", "30/60")),
+    "retrieve": parse_limit(os.getenv("RATE_LIMIT_RETRIEVE", "120/60")),
+    "ingest": parse_limit(os.getenv("RATE_LIMIT_INGEST", "10/60")),
+    # Batch queries (one token each) draw from their own, larger bucket so evaluation runs do not need
+    # the interactive generate limit raised
+    "batch": parse_limit(os.getenv("RATE_LIMIT_BATCH", "2048/3600")),
+})
+
+# Global caps on concurrent ingests and LLM calls; a bounded number of requests may queue for a slot.
+# Queued requests wait on the event loop, but each active call holds one of the threadpool's
+# 40 workers, so keep MAX_CONCURRENT_LLM_CALLS + MAX_CONCURRENT_INGESTS well below that
+ingest_gate = AdmissionGate(
+    "ingest",
+    max_active=int(os.getenv("MAX_CONCURRENT_INGESTS", 2)),
+    max_waiting=int(os.getenv("MAX_QUEUED_INGESTS", 8)),
+    timeout=float(os.getenv("INGEST_QUEUE_TIMEOUT", 30))
+)
+llm_gate = AdmissionGate(
+    "llm",
+    max_active=int(os.getenv("MAX_CONCURRENT_LLM_CALLS", 16)),
+    max_waiting=int(os.getenv("MAX_QUEUED_LLM_CALLS", 64)),
+    timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", 20))
+)
+
+@app.exception_handler(UnknownModel)
+async def unknown_model(request: Request, exc: UnknownModel):
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
+
+@app.exception_handler(CostExceedsLimit)
+async def cost_exceeds_limit(request: Request, exc: CostExceedsLimit):
+    return JSONResponse(status_code=413, content={"detail": str(exc)})
+
+@app.exception_handler(RateLimited)
+@app.exception_handler(Overloaded)
+async def too_many_requests(request: Request, exc: Exception):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(int(exc.retry_after))}
+    )
+
 # Middleware
 app.add_middleware(SessionMiddleware, secret_key=os.getenv("SECRET_KEY", "your-secret-key"))
 app.add_middleware(
@@ -55,11 +145,19 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
-# Configure Gemini
+# Configure Gemini; GEMINI_API_ENDPOINT sends calls to another host over REST, e.g. the load-test stub
 if "GOOGLE_API_KEY" in os.environ:
-    genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
+    if os.getenv("GEMINI_API_ENDPOINT"):
+        genai.configure(
+            api_key=os.environ["GOOGLE_API_KEY"],
+            transport="rest",
+            client_options={"api_endpoint": os.environ["GEMINI_API_ENDPOINT"]}
+        )
+    else:
+        genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
 
 # OAuth Configuration
 oauth = OAuth()
@@ -98,6 +196,12 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         raise HTTPException(status_code=401, detail="User not found")
     return {"id": user[0], "email": user[1]}
 
+def rate_limited(endpoint_class: str):
+    def dependency(current_user: dict = Depends(get_current_user)):
+        rate_limiter.check(current_user['id'], endpoint_class)
+        return current_user
+    return dependency
+
 # Models
 class UserCreate(BaseModel):
     email: str
@@ -111,8 +215,33 @@ class PromptRequest(BaseModel):
     query: str
     model: str = "gemini-1.5-flash"
     mode: str = "engineer" # engineer, critic, direct
+    template_version: Optional[int] = None # pin a template version; latest by default
     context_files: Optional[List[str]] = None
 
+class BatchPromptRequest(BaseModel):
+    queries: List[str]
+    model: str = "gemini-1.5-flash"
+    mode: str = "engineer"
+    save_history: bool = False
+
+class RefineSessionCreate(BaseModel):
+    prompt: str
+
+class RefineTurnRequest(BaseModel):
+    instruction: str
+    model: str = "gemini-1.5-flash"
+    ground: bool = False
+
+class RetrieveRequest(BaseModel):
+    query: Optional[str] = None
+    embedding: Optional[List[float]] = None
+    top_k: int = 5
+    # Exact matches on metadata; values keep their JSON type, e.g. {"page": 2} matches the stored integer
+    filters: Optional[Dict[str, Union[str, int, float, bool]]] = None
+    min_similarity: Optional[float] = None
+    include_embeddings: bool = False
+    embedding_format: Literal["json", "base64"] = "json"
+
 class RefineRequest(BaseModel):
     current_prompt: str
     instruction: str
@@ -122,7 +251,14 @@ class RefineRequest(BaseModel):
 # ... (existing code) ...
 
 @app.post("/api/refine")
-def refine_prompt(request: RefineRequest, current_user: dict = Depends(get_current_user)):
+async def refine_prompt(request: RefineRequest, current_user: dict = Depends(rate_limited("generate"))):
+    if request.model not in GEMINI_MODELS:
+        raise UnknownModel(request.model)
+    # Queue for the LLM on the event loop; only the call itself occupies a threadpool worker
+    async with llm_gate.async_slot():
+        return await run_in_threadpool(_refine, request)
+
+def _refine(request: RefineRequest):
     try:
         model = genai.GenerativeModel(request.model)
         
@@ -164,6 +300,87 @@ def refine_prompt(request: RefineRequest, current_user: dict = Depends(get_curre
             "ai_response": "I encountered an error while refining. Please try again."
         }
 
+# Server-side refinement sessions: the client sends only the new instruction each turn
+REFINE_RECENT_TURNS = int(os.getenv("REFINE_RECENT_TURNS", 4))
+REFINE_GROUNDING_TOKENS = int(os.getenv("REFINE_GROUNDING_TOKENS", 600))
+
+@app.post("/api/refine/sessions")
+def create_refine_session(request: RefineSessionCreate, current_user: dict = Depends(get_current_user)):
+    return rag_engine.create_refine_session(request.prompt, user_id=current_user['id'])
+
+@app.get("/api/refine/sessions/{session_id}")
+def get_refine_session(session_id: int, current_user: dict = Depends(get_current_user)):
+    session = rag_engine.get_refine_session(session_id, user_id=current_user['id'], recent_turns=REFINE_RECENT_TURNS)
+    if not session:
+        raise HTTPException(status_code=404, detail="Refinement session not found")
+    return session
+
+@app.post("/api/refine/sessions/{session_id}/turns")
+async def refine_session_turn(session_id: int, request: RefineTurnRequest, current_user: dict = Depends(rate_limited("generate"))):
+    session = await run_in_threadpool(
+        rag_engine.get_refine_session, session_id, user_id=current_user['id'], recent_turns=REFINE_RECENT_TURNS
+    )
+    if not session:
+        raise HTTPException(status_code=404, detail="Refinement session not found")
+    
+    grounding = ""
+    if request.ground:
+        results = await run_in_threadpool(
+            rag_engine.query,
+            f"{request.instruction}\n{session['current_prompt']}",
+            user_id=current_user['id'],
+            n_results=CONTEXT_CANDIDATES,
+            with_embeddings=True
+        )
+        packed = pack_context(results, budget=REFINE_GROUNDING_TOKENS)
+        if packed["chunks"]:
+            grounding = "CONTEXT FROM KNOWLEDGE BASE:\n" + "\n\n".join(packed["chunks"]) + "\n\n"
+    
+    template = prompt_registry.get("refine_session")
+    turn_prompt = template.render(
+        summary=session["summary"] or "(none yet)",
+        recent="\n".join(f"{turn['role'].upper()}: {turn['content']}" for turn in session["turns"]) or "(none)",
+        grounding=grounding,
+        prompt=session["current_prompt"],
+        instruction=request.instruction
+    )
+    
+    # The static instructions live in the (possibly provider-cached) system instruction; building
+    # that cache is a network call, so it runs in the threadpool
+    model = await run_in_threadpool(model_cache.get, request.model, template.system_instruction)
+    async with llm_gate.async_slot():
+        try:
+            response = await run_in_threadpool(
+                model.generate_content, turn_prompt, generation_config={"response_mime_type": "application/json"}
+            )
+            result = json.loads(response.text)
+            if not isinstance(result, dict):
+                raise ValueError(f"Expected a JSON object, got {type(result).__name__}")
+        except Exception as e:
+            print(f"Refinement Error: {e}")
+            return {
+                "session_id": session_id,
+                "refined_prompt": session["current_prompt"],
+                "ai_response": "I encountered an error while refining. Please try again."
+            }
+    
+    refined_prompt = result.get("refined_prompt", session["current_prompt"])
+    ai_response = result.get("ai_response", "")
+    await run_in_threadpool(
+        rag_engine.update_refine_session,
+        session_id,
+        refined_prompt,
+        result.get("summary", session["summary"]),
+        [("user", request.instruction), ("ai", ai_response)],
+        user_id=current_user['id']
+    )
+    return {
+        "session_id": session_id,
+        "refined_prompt": refined_prompt,
+        "ai_response": ai_response,
+        "usage": usage_summary(response, count_tokens(grounding))
+    }
+
 # Auth Routes
 @app.get("/api/auth/login/{provider}")
 async def login_via_provider(request: Request, provider: str):
@@ -227,125 +444,263 @@ def login(user: UserLogin):
     return {"access_token": access_token, "token_type": "bearer"}
 
 # API Routes
-@app.post("/api/generate")
-def generate_prompt(request: PromptRequest, current_user: dict = Depends(get_current_user)):
-    # 1. Retrieve relevant context
-    results = rag_engine.query(request.query, user_id=current_user['id'])
-    context = results["documents"][0]
-    sources = [m["source"] for m in results["metadatas"][0]]
-    
-    # 2. Construct prompt with context
-    context_str = "\n\n".join(context)
-    
-    # Define System Prompts based on Mode
-    system_instructions = {
-        "engineer": """
-ROLE: You are an expert Prompt Engineer and Research Assistant.
-TASK: The user will provide a goal or a rough question. You must rewrite this into a highly effective, detailed, and structured prompt that will get the best possible results from a Large Language Model.
-GUIDELINES:
-1. Do not just repeat the user's input.
-2. Add specific instructions for formatting.
-3. If the user mentions "Knowledge Base", explicitly instruct the model to "Search the vector database thoroughly".
-4. Use advanced prompting techniques like Chain of Thought.
-INPUT: {user_input}
-OUTPUT: [Only the optimized prompt]
-""",
-        "critic": """
-ROLE: You are a Critical Reviewer.
-TASK: Analyze the user's request and the provided context. Identify gaps, vague terms, or potential misunderstandings.
-GUIDELINES:
-1. Be constructive but strict.
-2. Point out what is missing from the user's request.
-3. Suggest specific improvements.
-INPUT: {user_input}
-OUTPUT: [Critique and Suggestions]
-""",
-        "direct": """
-ROLE: You are a Knowledge Base Assistant.
-TASK: Answer the user's question directly using ONLY the provided context.
-GUIDELINES:
-1. Do not hallucinate. If the answer isn't in the context, say so.
-2. Cite the specific documents (e.g., [Source: filename]) when making claims.
-INPUT: {user_input}
-OUTPUT: [Direct Answer]
-"""
+def usage_summary(response, context_tokens: int, template=None) -> dict:
+    usage = getattr(response, "usage_metadata", None)
+    return {
+        "context_tokens": context_tokens,
+        "template_tokens": template.system_tokens + template.request_overhead_tokens if template else None,
+        "cached_tokens": getattr(usage, "cached_content_token_count", None),
+        "prompt_tokens": getattr(usage, "prompt_token_count", None),
+        "output_tokens": getattr(usage, "candidates_token_count", None)
     }
 
-    selected_instruction = system_instructions.get(request.mode, system_instructions["engineer"])
-
-    full_prompt = f"""
-    You are an expert Prompt Engineer. Your goal is to create a highly optimized prompt based on the user's request and the provided context.
-    
-    USER REQUEST: {request.query}
-    
-    CONTEXT FROM KNOWLEDGE BASE:
-    {context_str}
+@app.post("/api/generate")
+async def generate_prompt(request: PromptRequest, current_user: dict = Depends(rate_limited("generate"))):
+    # 1. Retrieve relevant context, then pack the best non-redundant chunks into the token budget
+    results = await run_in_threadpool(
+        rag_engine.query, request.query, user_id=current_user['id'], n_results=CONTEXT_CANDIDATES, with_embeddings=True
+    )
+    packed = pack_context(results)
+    context = packed["chunks"]
+    sources = packed["sources"]
     
-    INSTRUCTIONS:
-    - Analyze the user's request and the context.
-    - Create a structured prompt (Role, Context, Task, Constraints).
-    - If the context is relevant, incorporate it into the generated prompt.
-    - If the context is NOT relevant, ignore it.
-    """
+    # 2. Construct prompt with context; the mode's system instruction is the stable, cacheable prefix
+    try:
+        template = prompt_registry.get(request.mode, request.template_version, fields=GENERATION_FIELDS)
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=str(e.args[0]))
+    full_prompt = template.render(query=request.query, context="\n\n".join(context))
     
     # 3. Generate response using Gemini
+    model = await run_in_threadpool(model_cache.get, request.model, template.system_instruction)
     try:
-        model = genai.GenerativeModel(request.model)
-        response = model.generate_content(full_prompt)
+        # Waiting for a slot happens on the event loop, not in a threadpool worker
+        async with llm_gate.async_slot():
+            response = await run_in_threadpool(model.generate_content, full_prompt)
         generated_prompt = response.text
         
-        # 4. Save to history
-        rag_engine.save_chat(request.query, generated_prompt, user_id=current_user['id'])
+        # 4. Save to history (queued; the response does not wait on the insert)
+        history_writer.enqueue(request.query, generated_prompt, user_id=current_user['id'])
         
-        return {"response": generated_prompt, "sources": sources, "context": context}
+        return {
+            "response": generated_prompt,
+            "sources": sources,
+            "context": context,
+            "template": template.key,
+            "usage": usage_summary(response, packed["tokens"], template)
+        }
     except Exception as e:
+        if isinstance(e, Overloaded):
+            raise
         print(f"Gemini Error: {e}")
         return {"response": "Error generating prompt. Please try again.", "sources": [], "context": []}
 
+MAX_RETRIEVE_TOP_K = int(os.getenv("MAX_RETRIEVE_TOP_K", 50))
+
+@app.post("/api/retrieve")
+def retrieve(request: RetrieveRequest, current_user: dict = Depends(rate_limited("retrieve"))):
+    if (request.query is None) == (request.embedding is None):
+        raise HTTPException(status_code=400, detail="Provide exactly one of 'query' or 'embedding'")
+    top_k = max(1, min(request.top_k, MAX_RETRIEVE_TOP_K))
+    
+    # Callers with their own embeddings skip the encoder entirely
+    embedding = request.embedding
+    if embedding is None:
+        embedding = rag_engine.model.encode(request.query).tolist()
+    try:
+        results = rag_engine.search(
+            embedding,
+            user_id=current_user['id'],
+            n_results=top_k,
+            with_embeddings=request.include_embeddings,
+            filters=request.filters,
+            min_similarity=request.min_similarity
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    chunks = []
+    for i, content in enumerate(results["documents"][0]):
+        chunk = {
+            "content": content,
+            "metadata": results["metadatas"][0][i],
+            "score": 1 - results["distances"][0][i]
+        }
+        if request.include_embeddings:
+            vector = results["embeddings"][0][i]
+            if request.embedding_format == "base64":
+                # Little-endian float32, ~4x smaller than JSON floats
+                vector = base64.b64encode(np.asarray(vector, dtype="<f4").tobytes()).decode()
+            chunk["embedding"] = vector
+        chunks.append(chunk)
+    return {"results": chunks, "embedding_format": request.embedding_format if request.include_embeddings else None}
+
+# Batch generation limits
+# A batch larger than the whole batch bucket could never be admitted, so the bucket also caps the batch size
+MAX_BATCH_QUERIES = min(int(os.getenv("MAX_BATCH_QUERIES", 256)), int(rate_limiter.limits["batch"][0]))
+LLM_BATCH_CONCURRENCY = int(os.getenv("LLM_BATCH_CONCURRENCY", 8))
+
+@app.post("/api/generate/batch")
+async def generate_batch(request: BatchPromptRequest, current_user: dict = Depends(get_current_user)):
+    if not request.queries:
+        raise HTTPException(status_code=400, detail="No queries provided")
+    if len(request.queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {MAX_BATCH_QUERIES} queries per batch (MAX_BATCH_QUERIES, capped by RATE_LIMIT_BATCH)"
+        )
+    try:
+        template = prompt_registry.get(request.mode, fields=GENERATION_FIELDS)
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=str(e.args[0]))
+    model = await run_in_threadpool(model_cache.get, request.model, template.system_instruction)
+    # Each query in the batch costs one batch token; the Postgres store is a DB round trip, so keep it off the loop
+    await run_in_threadpool(rate_limiter.check, current_user['id'], "batch", cost=len(request.queries))
+    
+    # One encoder call and one SQL round trip for every query in the batch
+    all_results = await run_in_threadpool(
+        rag_engine.query_many, request.queries, current_user['id'], CONTEXT_CANDIDATES, True
+    )
+    llm_slots = asyncio.Semaphore(LLM_BATCH_CONCURRENCY)
+    
+    async def generate_one(index: int, query: str, results: dict):
+        packed = pack_context(results)
+        full_prompt = template.render(query=query, context="\n\n".join(packed["chunks"]))
+        try:
+            async with llm_slots, llm_gate.async_slot():
+                response = await model.generate_content_async(full_prompt)
+            if request.save_history:
+                history_writer.enqueue(query, response.text, current_user['id'])
+            return {
+                "index": index,
+                "query": query,
+                "response": response.text,
+                "sources": packed["sources"],
+                "template": template.key,
+                "usage": usage_summary(response, packed["tokens"], template)
+            }
+        except Exception as e:
+            print(f"Gemini Error: {e}")
+            return {"index": index, "query": query, "error": str(e)}
+    
+    async def stream_results():
+        # Results go out as NDJSON lines in completion order; "index" maps them back to the request
+        tasks = [
+            asyncio.create_task(generate_one(i, query, results))
+            for i, (query, results) in enumerate(zip(request.queries, all_results))
+        ]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield json.dumps(await finished) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
 @app.post("/api/ingest/text")
-def ingest_text(text: str = Form(...), metadata: str = Form(...), current_user: dict = Depends(get_current_user)):
+def ingest_text(text: str = Form(...), metadata: str = Form(...), current_user: dict = Depends(rate_limited("ingest"))):
     try:
         meta_dict = json.loads(metadata)
         rag_engine.add_document(text, meta_dict, user_id=current_user['id'])
         return {"message": "Text ingested successfully"}
+    except ValueError as e:
+        # Malformed JSON or metadata; nothing has been written
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         return {"message": f"Error: {str(e)}", "error": True}
 
-@app.post("/api/ingest/file")
-async def ingest_file(file: UploadFile = File(...), current_user: dict = Depends(get_current_user)):
-    content = await file.read()
-    chunks = []
-    
-    if file.content_type.startswith("image/"):
-        chunks = extract_text_from_image(content)
-    elif file.content_type == "application/pdf":
-        chunks = extract_text_from_pdf(content)
+# The body is parsed by read_upload inside the ingest slot, not by FastAPI before the handler runs
+INGEST_FILE_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {"multipart/form-data": {"schema": {
+            "type": "object",
+            "properties": {"file": {"type": "string", "format": "binary"}},
+            "required": ["file"]
+        }}}
+    }
+}
+
+@app.post("/api/ingest/file", openapi_extra=INGEST_FILE_BODY)
+async def ingest_file(request: Request, current_user: dict = Depends(rate_limited("ingest"))):
+    async with ingest_gate.async_slot():
+        try:
+            file = await read_upload(request)
+        except UploadTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        except (ValueError, MultiPartException) as e:
+            raise HTTPException(status_code=400, detail=getattr(e, "message", str(e)))
+        
+        with file.file:
+            chunks = []
+            content_type = file.content_type or ""
+            # The extractors read the parser's spooled file directly; there is no second copy
+            if content_type.startswith("image/"):
+                chunks = await run_in_threadpool(extract_text_from_image, file.file)
+            elif content_type == "application/pdf":
+                chunks = await run_in_threadpool(extract_text_from_pdf, file.file)
         
-    if chunks:
-        for chunk in chunks:
-            rag_engine.add_document(
-                chunk["text"], 
-                {
+        if chunks:
+            # Re-uploading a file replaces its previous version; only changed pages are re-embedded
+            for chunk in chunks:
+                chunk["metadata"] = {
                     "source": file.filename, 
                     "type": "file", 
                     "page": chunk["metadata"]["page"]
-                },
-                user_id=current_user['id']
-            )
-        return {
-            "message": f"File {file.filename} ingested successfully ({len(chunks)} pages/chunks)", 
-            "extracted_text_preview": chunks[0]["text"][:100] if chunks else ""
-        }
-    else:
-        return {"message": "Failed to extract text", "error": True} 
+                }
+            changes = await run_in_threadpool(rag_engine.sync_source, file.filename, chunks, current_user['id'])
+            return {
+                "message": f"File {file.filename} ingested successfully ({len(chunks)} pages/chunks)", 
+                "extracted_text_preview": chunks[0]["text"][:100] if chunks else "",
+                **changes
+            }
+        else:
+            return {"message": "Failed to extract text", "error": True} 
 
 @app.get("/api/documents")
-def list_documents(limit: int = 100, current_user: dict = Depends(get_current_user)):
-    return rag_engine.list_documents(user_id=current_user['id'], limit=limit)
+def list_documents(limit: int = 100, cursor: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    limit = max(1, min(limit, 500))
+    try:
+        return rag_engine.list_documents(user_id=current_user['id'], limit=limit, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.delete("/api/documents/{source:path}")
+def delete_document(source: str, current_user: dict = Depends(get_current_user)):
+    deleted = rag_engine.delete_source(source, user_id=current_user['id'])
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return {"message": f"Deleted {source}", "removed": deleted}
 
 @app.get("/api/history")
-def get_history(limit: int = 50, current_user: dict = Depends(get_current_user)):
-    return rag_engine.get_chat_history(user_id=current_user['id'], limit=limit)
+def get_history(
+    response: Response,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    preview: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    limit = max(1, min(limit, 500))
+    try:
+        history = rag_engine.get_chat_history(user_id=current_user['id'], limit=limit, cursor=cursor, preview=preview)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Body stays a plain list; the next page cursor travels in a header
+    if len(history) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(history[-1]["timestamp"], history[-1]["id"])
+    return history
+
+@app.get("/api/history/export")
+def export_history(current_user: dict = Depends(get_current_user)):
+    def ndjson():
+        for item in rag_engine.iter_chat_history(user_id=current_user['id']):
+            yield json.dumps(item) + "\n"
+    return StreamingResponse(
+        ndjson(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": "attachment; filename=history.ndjson"}
+    )
 
 @app.get("/api/history/{chat_id}")
 def get_chat_item(chat_id: int, current_user: dict = Depends(get_current_user)):
@@ -354,6 +709,26 @@ def get_chat_item(chat_id: int, current_user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=404, detail="Chat item not found")
     return item
 
+# Internal endpoint: disabled unless METRICS_TOKEN is set, and then only for callers presenting it
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+def require_metrics_token(x_metrics_token: Optional[str] = Header(None)):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_metrics_token or not secrets.compare_digest(x_metrics_token, METRICS_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+
+@app.get("/api/metrics", include_in_schema=False, dependencies=[Depends(require_metrics_token)])
+def metrics():
+    return {
+        "embedding_model": rag_engine.model_id,
+        "history_writer": history_writer.stats(),
+        "admission": {"ingest": ingest_gate.stats(), "llm": llm_gate.stats()},
+        "llm_cache": model_cache.stats,
+        "templates": prompt_registry.describe(),
+        "db": rag_engine.statement_stats.snapshot()
+    }
+
 @app.get("/")
 def read_root():
     return {"message": "RAG Prompt Engine API is running"}
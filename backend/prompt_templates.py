@@ -0,0 +1,164 @@
+import string
+from context import count_tokens
+
+class PromptTemplate:
+    """A versioned prompt split into a stable system instruction and a per-request part.
+
+    The system instruction never changes between calls, so it is sent as the model's
+    system instruction (and provider-cached when large enough); only the rendered
+    request part varies. Placeholders are checked and token counts taken once, at load.
+    """
+
+    def __init__(self, name: str, version: int, system_instruction: str, request_template: str, fields: tuple):
+        self.name = name
+        self.version = version
+        self.system_instruction = system_instruction.strip()
+        self.request_template = request_template.strip()
+        used = {field for _, field, _, _ in string.Formatter().parse(self.request_template) if field}
+        if used != set(fields):
+            raise ValueError(f"Template {self.key} expects fields {sorted(fields)}, found {sorted(used)}")
+        self.fields = tuple(fields)
+        self.system_tokens = count_tokens(self.system_instruction)
+        self.request_overhead_tokens = count_tokens(self.request_template.format(**{f: "" for f in fields}))
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}@v{self.version}"
+
+    def render(self, **values) -> str:
+        return self.request_template.format(**values)
+
+class TemplateRegistry:
+    def __init__(self, default: str):
+        self.default = default
+        self._templates = {}
+
+    def register(self, template: PromptTemplate):
+        versions = self._templates.setdefault(template.name, {})
+        if template.version in versions:
+            raise ValueError(f"Template {template.key} is already registered")
+        versions[template.version] = template
+
+    def get(self, name: str = None, version: int = None, fields: tuple = None) -> PromptTemplate:
+        """Latest version of `name`, or a pinned one; unknown names fall back to the default.
+
+        With `fields`, a template that takes different fields raises KeyError, so callers
+        cannot pick a template meant for another endpoint.
+        """
+        versions = self._templates.get(name) or self._templates[self.default]
+        if version is None:
+            template = versions[max(versions)]
+        elif version not in versions:
+            raise KeyError(f"Unknown version {version} of template '{name}'")
+        else:
+            template = versions[version]
+        if fields is not None and template.fields != tuple(fields):
+            raise KeyError(f"Template '{name}' is not a generation mode")
+        return template
+
+    def latest(self) -> list:
+        return [versions[max(versions)] for versions in self._templates.values()]
+
+    def describe(self) -> list:
+        return [
+            {
+                "name": t.name,
+                "version": t.version,
+                "system_tokens": t.system_tokens,
+                "request_overhead_tokens": t.request_overhead_tokens,
+            }
+            for versions in self._templates.values()
+            for t in versions.values()
+        ]
+
+# Fields of every generation mode (engineer, critic, direct)
+GENERATION_FIELDS = ("query", "context")
+
+GENERATION_REQUEST = """
+USER REQUEST: {query}
+
+CONTEXT FROM KNOWLEDGE BASE:
+{context}
+"""
+
+TEMPLATES = [
+    # v1 is the single generation prompt used before modes were applied; kept so clients can pin it
+    PromptTemplate("engineer", 1, """
+You are an expert Prompt Engineer. Your goal is to create a highly optimized prompt based on the user's request and the provided context.
+
+INSTRUCTIONS:
+- Analyze the user's request and the context.
+- Create a structured prompt (Role, Context, Task, Constraints).
+- If the context is relevant, incorporate it into the generated prompt.
+- If the context is NOT relevant, ignore it.
+""", GENERATION_REQUEST, GENERATION_FIELDS),
+    PromptTemplate("engineer", 2, """
+ROLE: You are an expert Prompt Engineer and Research Assistant.
+TASK: The user will provide a goal or a rough question, together with context from their knowledge base. You must rewrite this into a highly effective, detailed, and structured prompt (Role, Context, Task, Constraints) that will get the best possible results from a Large Language Model.
+GUIDELINES:
+1. Do not just repeat the user's input.
+2. Add specific instructions for formatting.
+3. If the user mentions "Knowledge Base", explicitly instruct the model to "Search the vector database thoroughly".
+4. Use advanced prompting techniques like Chain of Thought.
+5. Incorporate the context only where it is relevant to the request; otherwise ignore it.
+OUTPUT: [Only the optimized prompt]
+""", GENERATION_REQUEST, GENERATION_FIELDS),
+    PromptTemplate("critic", 1, """
+ROLE: You are a Critical Reviewer.
+TASK: Analyze the user's request and the provided context. Identify gaps, vague terms, or potential misunderstandings.
+GUIDELINES:
+1. Be constructive but strict.
+2. Point out what is missing from the user's request.
+3. Suggest specific improvements.
+OUTPUT: [Critique and Suggestions]
+""", GENERATION_REQUEST, GENERATION_FIELDS),
+    PromptTemplate("direct", 1, """
+ROLE: You are a Knowledge Base Assistant.
+TASK: Answer the user's question directly using ONLY the provided context.
+GUIDELINES:
+1. Do not hallucinate. If the answer isn't in the context, say so.
+2. Cite the specific documents (e.g., [Source: filename]) when making claims.
+OUTPUT: [Direct Answer]
+""", GENERATION_REQUEST, GENERATION_FIELDS),
+    PromptTemplate("refine_session", 1, """
+ROLE: You are an expert Prompt Engineer and collaborative assistant.
+
+TASK:
+1. Analyze the USER INSTRUCTION to refine the CURRENT PROMPT.
+2. Rewrite the CURRENT PROMPT to strictly adhere to the instruction.
+3. Provide a brief, helpful response to the user explaining what you changed.
+4. Update the running summary of this refinement conversation so it also covers this turn.
+
+You receive a CONVERSATION SUMMARY of earlier turns, the most RECENT TURNS verbatim,
+optionally CONTEXT FROM KNOWLEDGE BASE, then the CURRENT PROMPT and USER INSTRUCTION.
+Use knowledge base context only where it is relevant to the instruction.
+
+OUTPUT FORMAT (JSON):
+{
+    "refined_prompt": "The fully rewritten text of the prompt",
+    "ai_response": "A brief, friendly message to the user about the changes",
+    "summary": "Two to four sentences capturing the goals and decisions of the conversation so far"
+}
+""", """
+CONVERSATION SUMMARY:
+{summary}
+
+RECENT TURNS:
+{recent}
+
+{grounding}CURRENT PROMPT:
+{prompt}
+
+USER INSTRUCTION:
+{instruction}
+""", ("summary", "recent", "grounding", "prompt", "instruction")),
+]
+
+def load_templates(templates=TEMPLATES) -> TemplateRegistry:
+    registry = TemplateRegistry(default="engineer")
+    for template in templates:
+        registry.register(template)
+    return registry
+
+# Built once at import; request handlers only look templates up
+prompt_registry = load_templates()
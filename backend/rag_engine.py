@@ -1,39 +1,216 @@
 import os
-import psycopg2
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 from sentence_transformers import SentenceTransformer
-from typing import List, Dict
+from typing import List, Dict, Optional
 import json
-import urllib.parse
+import base64
+import hashlib
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from embedding_models import EMBEDDING_MODELS, DEFAULT_EMBEDDING_MODEL
+from db import (
+    connect, StatementStats, is_transient, needs_reconnect, positional, backoff,
+    DB_STATEMENT_TIMEOUT_MS, DB_SEARCH_TIMEOUT_MS, DB_READ_RETRIES, DB_PREPARED_STATEMENTS,
+    PREPARED_STATEMENT_MISSING, DUPLICATE_PREPARED_STATEMENT
+)
 
 load_dotenv()
 
+PREVIEW_CHARS = 200
+HISTORY_PREVIEW_CHARS = 280
+
+# Vacuum documents once dead rows exceed this share of live rows
+VACUUM_DEAD_RATIO = float(os.getenv("VACUUM_DEAD_RATIO", 0.1))
+VACUUM_MIN_DEAD_ROWS = int(os.getenv("VACUUM_MIN_DEAD_ROWS", 1000))
+
+def encode_cursor(timestamp: str, row_id: int) -> str:
+    # Opaque keyset cursor: the (timestamp, id) of the last row on the page
+    raw = json.dumps([timestamp, row_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return timestamp, int(row_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+# Per-source summary built from the chunk rows; {where} selects which sources to summarise
+SOURCE_SUMMARY_SQL = """
+    SELECT agg.user_id, agg.source, first.metadata, agg.chunk_count,
+           agg.page_count, agg.bytes, left(first.content, %s)
+    FROM (
+        SELECT user_id,
+               metadata->>'source' AS source,
+               min(id) AS first_id,
+               count(*) AS chunk_count,
+               greatest(count(DISTINCT metadata->>'page'), 1) AS page_count,
+               coalesce(sum(octet_length(content)), 0) AS bytes
+        FROM documents
+        WHERE {where}
+        GROUP BY user_id, metadata->>'source'
+    ) agg
+    JOIN documents first ON first.id = agg.first_id
+"""
+
 class RAGEngine:
     def __init__(self, db_url=None):
         self.db_url = db_url or os.getenv("DATABASE_URL")
         if not self.db_url:
             raise ValueError("DATABASE_URL environment variable is not set")
         
-        try:
-            self.conn = psycopg2.connect(self.db_url)
-        except Exception as e:
-            print(f"Direct connection failed: {e}, attempting manual parsing...")
-            url = urllib.parse.urlparse(self.db_url)
-            self.conn = psycopg2.connect(
-                dbname=url.path[1:],
-                user=url.username,
-                password=url.password,
-                host=url.hostname,
-                port=url.port,
-                sslmode='require'
-            )
+        self.statement_stats = StatementStats()
+        self._prepared = set()
+        self._prepare_lock = threading.Lock()
+        self._reconnect_lock = threading.Lock()
+        self.conn = self._connect()
         self.conn.autocommit = True
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
         
         self._init_db()
+        self.model_id = self._resolve_active_model(os.getenv("EMBEDDING_MODEL"))
+        spec = EMBEDDING_MODELS[self.model_id]
+        self.column = spec["column"]
+        self.dim = spec["dim"]
+        self.model = SentenceTransformer(spec["name"])
+
+    def _connect(self):
+        return connect(self.db_url)
+
+    def reconnect(self):
+        """Open a fresh shared connection, e.g. in a worker forked from a preloading server."""
+        self.conn = self._connect()
+        self.conn.autocommit = True
+        # Prepared statements belong to the old session
+        self._prepared = set()
+
+    def _replace_connection(self, broken):
+        with self._reconnect_lock:
+            # Another thread may already have replaced it
+            if self.conn is not broken:
+                return
+            try:
+                broken.close()
+            except Exception:
+                pass
+            self.reconnect()
+
+    @contextmanager
+    def _timed(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.statement_stats.record(name, time.perf_counter() - started, e)
+            raise
+        self.statement_stats.record(name, time.perf_counter() - started)
+
+    def _execute(self, cur, name: str, sql: str, params=None, timeout_ms: int = DB_STATEMENT_TIMEOUT_MS):
+        """Run one statement under its own timeout, recording latency and errors under `name`."""
+        # Same round trip as the statement. Both run as one implicit transaction, so SET LOCAL
+        # ends with it and the session (or a pooler's server connection) keeps its own bound
+        with self._timed(name):
+            cur.execute(f"SET LOCAL statement_timeout = {int(timeout_ms)}; {sql}", params)
+
+    def _execute_prepared(self, cur, name: str, sql: str, params: tuple, timeout_ms: int = DB_STATEMENT_TIMEOUT_MS):
+        """Run `sql`, written with $n placeholders, as a server-side prepared statement."""
+        if not DB_PREPARED_STATEMENTS:
+            sql, params = positional(sql, params)
+            return self._execute(cur, name, sql, params, timeout_ms)
+        with self._prepare_lock:
+            if name not in self._prepared:
+                try:
+                    cur.execute(f"PREPARE {name} AS {sql}")
+                except Exception as e:
+                    # The session already has it, e.g. prepared before the set was last reset
+                    if getattr(e, "pgcode", None) != DUPLICATE_PREPARED_STATEMENT:
+                        raise
+                self._prepared.add(name)
+        placeholders = ", ".join(["%s"] * len(params))
+        self._execute(cur, name, f"EXECUTE {name} ({placeholders})", params, timeout_ms)
+
+    def _read(self, name: str, run):
+        """Run an idempotent read, reconnecting and retrying when it fails transiently.
+
+        `name` must be the statement name `run` executes under, so retries land on the same stats entry.
+        """
+        for attempt in range(DB_READ_RETRIES + 1):
+            conn = self.conn
+            try:
+                with conn.cursor() as cur:
+                    return run(cur)
+            except Exception as e:
+                if attempt == DB_READ_RETRIES or not is_transient(e):
+                    raise
+                print(f"Transient database error in {name}, retrying: {e}")
+                self.statement_stats.record_retry(name)
+                if getattr(e, "pgcode", None) == PREPARED_STATEMENT_MISSING:
+                    # Start the session over so every statement is prepared afresh, not just this one
+                    try:
+                        with self._prepare_lock, conn.cursor() as cur:
+                            cur.execute("DEALLOCATE ALL")
+                            self._prepared = set()
+                    except Exception as deallocate_error:
+                        print(f"Could not reset prepared statements: {deallocate_error}")
+                elif needs_reconnect(conn, e):
+                    try:
+                        self._replace_connection(conn)
+                    except Exception as reconnect_error:
+                        print(f"Reconnect failed: {reconnect_error}")
+                backoff(attempt)
+
+    @contextmanager
+    def transaction(self):
+        # Multi-statement writes get their own connection so they never interleave
+        # with the shared autocommit connection used by request handlers
+        conn = self._connect()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    yield cur
+        finally:
+            conn.close()
+
+    def _resolve_active_model(self, requested: Optional[str]) -> str:
+        """Switch models only when EMBEDDING_MODEL names one whose column covers the whole corpus.
+
+        Without EMBEDDING_MODEL the recorded active model is kept, so a process started with
+        the default environment never switches back to a model that lacks newer chunks.
+        """
+        if requested is not None and requested not in EMBEDDING_MODELS:
+            raise ValueError(f"Unknown EMBEDDING_MODEL '{requested}', expected one of {sorted(EMBEDDING_MODELS)}")
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT model_id FROM embedding_models WHERE active")
+            row = cur.fetchone()
+            active = row[0] if row and row[0] in EMBEDDING_MODELS else DEFAULT_EMBEDDING_MODEL
+            if requested is None or requested == active:
+                return active
+            
+            # completed_at alone goes stale: chunks ingested since the migration only have the active model's column
+            column = EMBEDDING_MODELS[requested]["column"]
+            cur.execute(f"""
+                SELECT completed_at IS NOT NULL AND NOT EXISTS (SELECT 1 FROM documents WHERE {column} IS NULL)
+                FROM embedding_models WHERE model_id = %s
+            """, (requested,))
+            row = cur.fetchone()
+            if not (row and row[0] is True):
+                print(f"Embedding model {requested} does not cover every chunk yet, staying on {active}. "
+                      f"Run: python embedding_migrator.py --model {requested}")
+                return active
+            
+            cur.execute("UPDATE embedding_models SET active = (model_id = %s)", (requested,))
+            print(f"Switched active embedding model from {active} to {requested}")
+            return requested
 
     def _init_db(self):
         with self.conn.cursor() as cur:
+            # Migrations and the one-time backfill may legitimately run long
+            cur.execute("SET statement_timeout = 0")
             cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS users (
@@ -56,85 +233,392 @@ class RAGEngine:
                     ai_message TEXT,
                     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 );
+                CREATE TABLE IF NOT EXISTS sources (
+                    id SERIAL PRIMARY KEY,
+                    user_id INTEGER REFERENCES users(id),
+                    source TEXT NOT NULL,
+                    metadata JSONB,
+                    chunk_count INTEGER NOT NULL DEFAULT 0,
+                    page_count INTEGER NOT NULL DEFAULT 0,
+                    bytes BIGINT NOT NULL DEFAULT 0,
+                    preview TEXT,
+                    ingested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE (user_id, source)
+                );
+                CREATE INDEX IF NOT EXISTS sources_user_ingested_idx
+                    ON sources (user_id, ingested_at DESC, id DESC);
+                CREATE INDEX IF NOT EXISTS chat_history_user_ts_idx
+                    ON chat_history (user_id, timestamp DESC, id DESC);
+                CREATE TABLE IF NOT EXISTS refine_sessions (
+                    id SERIAL PRIMARY KEY,
+                    user_id INTEGER REFERENCES users(id),
+                    current_prompt TEXT NOT NULL,
+                    summary TEXT NOT NULL DEFAULT '',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+                CREATE TABLE IF NOT EXISTS refine_turns (
+                    id SERIAL PRIMARY KEY,
+                    session_id INTEGER REFERENCES refine_sessions(id) ON DELETE CASCADE,
+                    role VARCHAR(16) NOT NULL,
+                    content TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+                CREATE INDEX IF NOT EXISTS refine_turns_session_idx
+                    ON refine_turns (session_id, id DESC);
             """)
             # Auto-migration for existing tables
             try:
                 cur.execute("ALTER TABLE documents ADD COLUMN IF NOT EXISTS user_id INTEGER REFERENCES users(id)")
                 cur.execute("ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS user_id INTEGER REFERENCES users(id)")
+                cur.execute("ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_hash TEXT")
+                cur.execute("CREATE INDEX IF NOT EXISTS documents_user_source_idx ON documents (user_id, (metadata->>'source'))")
             except Exception as e:
                 print(f"Migration warning: {e}")
 
+            # One vector column per registered model, plus migration state for each
+            try:
+                for spec in EMBEDDING_MODELS.values():
+                    cur.execute(f"ALTER TABLE documents ADD COLUMN IF NOT EXISTS {spec['column']} vector({spec['dim']})")
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS embedding_models (
+                        model_id TEXT PRIMARY KEY,
+                        active BOOLEAN NOT NULL DEFAULT FALSE,
+                        migrated_through INTEGER NOT NULL DEFAULT 0,
+                        processed BIGINT NOT NULL DEFAULT 0,
+                        started_at TIMESTAMP,
+                        completed_at TIMESTAMP
+                    )
+                """)
+                execute_values(cur, """
+                    INSERT INTO embedding_models (model_id) VALUES %s ON CONFLICT DO NOTHING
+                """, [(model_id,) for model_id in EMBEDDING_MODELS])
+                # Existing corpora were all embedded with the original model
+                cur.execute("""
+                    UPDATE embedding_models SET active = TRUE, completed_at = coalesce(completed_at, CURRENT_TIMESTAMP)
+                    WHERE model_id = %s AND NOT EXISTS (SELECT 1 FROM embedding_models WHERE active)
+                """, (DEFAULT_EMBEDDING_MODEL,))
+            except Exception as e:
+                print(f"Embedding model migration warning: {e}")
+
+            # Backfill the source catalog once for documents ingested before it existed
+            try:
+                cur.execute("SELECT EXISTS (SELECT 1 FROM sources)")
+                if not cur.fetchone()[0]:
+                    cur.execute(
+                        "INSERT INTO sources (user_id, source, metadata, chunk_count, page_count, bytes, preview)"
+                        + SOURCE_SUMMARY_SQL.format(where="metadata->>'source' IS NOT NULL")
+                        + "ON CONFLICT (user_id, source) DO NOTHING",
+                        (PREVIEW_CHARS,)
+                    )
+            except Exception as e:
+                print(f"Source catalog backfill warning: {e}")
+            cur.execute("RESET statement_timeout")
+
     def create_user(self, email, hashed_password):
+        # The shared connection is autocommit, so a duplicate email is reported as no row
+        # rather than raised (there is no transaction to roll back)
         with self.conn.cursor() as cur:
-            try:
-                cur.execute("INSERT INTO users (email, hashed_password) VALUES (%s, %s) RETURNING id", (email, hashed_password))
-                return cur.fetchone()[0]
-            except psycopg2.IntegrityError:
-                self.conn.rollback()
-                return None
+            self._execute(cur, "create_user", """
+                INSERT INTO users (email, hashed_password) VALUES (%s, %s)
+                ON CONFLICT (email) DO NOTHING
+                RETURNING id
+            """, (email, hashed_password))
+            row = cur.fetchone()
+            return row[0] if row else None
 
     def get_user(self, email):
-        with self.conn.cursor() as cur:
-            cur.execute("SELECT id, email, hashed_password FROM users WHERE email = %s", (email,))
+        def run(cur):
+            self._execute_prepared(cur, "get_user", "SELECT id, email, hashed_password FROM users WHERE email = $1", (email,))
             return cur.fetchone()
+        return self._read("get_user", run)
 
     def add_document(self, text: str, metadata: Dict, user_id: int):
+        # Reject bad metadata before anything is written: the chunk and its catalog entry go in together
+        if not isinstance(metadata, dict):
+            raise ValueError("Metadata must be a JSON object")
+        page = metadata.get("page")
+        if page is not None and (isinstance(page, bool) or not isinstance(page, int)):
+            raise ValueError("Metadata 'page' must be an integer")
         embedding = self.model.encode(text).tolist()
         
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO documents (content, metadata, embedding, user_id)
-                VALUES (%s, %s, %s, %s)
-            """, (text, json.dumps(metadata), embedding, user_id))
+        with self.transaction() as cur:
+            cur.execute(f"""
+                INSERT INTO documents (content, metadata, {self.column}, user_id, content_hash)
+                VALUES (%s, %s, %s, %s, %s)
+            """, (text, json.dumps(metadata), embedding, user_id, content_hash(text)))
+            self._update_source_catalog(cur, text, metadata, user_id)
 
-    def query(self, query_text: str, user_id: int, n_results: int = 5):
-        query_embedding = self.model.encode(query_text).tolist()
-        
-        with self.conn.cursor() as cur:
+    def _update_source_catalog(self, cur, text: str, metadata: Dict, user_id: int):
+        # Keep the per-source summary in step with the chunk rows so listing never scans documents
+        source = metadata.get("source")
+        if not source:
+            return
+        cur.execute("""
+            INSERT INTO sources (user_id, source, metadata, chunk_count, page_count, bytes, preview)
+            VALUES (%s, %s, %s, 1, %s, %s, %s)
+            ON CONFLICT (user_id, source) DO UPDATE SET
+                chunk_count = sources.chunk_count + 1,
+                page_count = greatest(sources.page_count, EXCLUDED.page_count),
+                bytes = sources.bytes + EXCLUDED.bytes,
+                ingested_at = CURRENT_TIMESTAMP
+        """, (
+            user_id,
+            source,
+            json.dumps(metadata),
+            int(metadata.get("page") or 1),
+            len(text.encode("utf-8")),
+            text[:PREVIEW_CHARS],
+        ))
+
+    def sync_source(self, source: str, chunks: List[Dict], user_id: int):
+        """Make the stored chunks for `source` match `chunks`, re-embedding only what changed."""
+        with self.transaction() as cur:
+            # Serialize syncs of the same source so concurrent uploads diff against each other's
+            # result rather than the same snapshot; other sources are not blocked
+            cur.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s))", (user_id, source))
             cur.execute("""
-                SELECT content, metadata, 1 - (embedding <=> %s::vector) as similarity
+                SELECT id,
+                       -- Rows stored with a non-integer page get NULL, match nothing and are replaced
+                       CASE WHEN metadata->'page' IS NULL THEN 1
+                            WHEN metadata->>'page' ~ '^[0-9]{1,9}$' THEN (metadata->>'page')::int
+                       END,
+                       coalesce(content_hash, encode(sha256(convert_to(content, 'UTF8')), 'hex'))
                 FROM documents
-                WHERE user_id = %s
-                ORDER BY embedding <=> %s::vector
-                LIMIT %s
-            """, (query_embedding, user_id, query_embedding, n_results))
+                WHERE user_id = %s AND metadata->>'source' = %s
+            """, (user_id, source))
+            existing = defaultdict(list)
+            for row_id, page, digest in cur.fetchall():
+                existing[(page, digest)].append(row_id)
             
-            rows = cur.fetchall()
+            # Match incoming chunks against stored ones by (page, hash); leftovers are stale
+            added = []
+            unchanged = 0
+            for chunk in chunks:
+                metadata = chunk["metadata"]
+                key = (int(metadata.get("page") or 1), content_hash(chunk["text"]))
+                if existing.get(key):
+                    existing[key].pop(0)
+                    unchanged += 1
+                else:
+                    added.append((chunk["text"], metadata, key[1]))
+            stale_ids = [row_id for ids in existing.values() for row_id in ids]
+            
+            # Only the advisory lock is held while embedding; no rows are locked until the writes
+            embeddings = self.model.encode([text for text, _, _ in added]).tolist() if added else []
             
-            results = {
-                "documents": [[row[0] for row in rows]],
-                "metadatas": [[row[1] for row in rows]],
-                "distances": [[1 - row[2] for row in rows]]
-            }
-            return results
-
-    def list_documents(self, user_id: int, limit: int = 100):
+            if stale_ids:
+                cur.execute("DELETE FROM documents WHERE id = ANY(%s)", (stale_ids,))
+            if added:
+                execute_values(cur, f"""
+                    INSERT INTO documents (content, metadata, {self.column}, user_id, content_hash)
+                    VALUES %s
+                """, [
+                    (text, json.dumps(metadata), embedding, user_id, digest)
+                    for (text, metadata, digest), embedding in zip(added, embeddings)
+                ], template="(%s, %s, %s::vector, %s, %s)")
+            self._refresh_source_catalog(cur, source, user_id, remaining=unchanged + len(added))
+        
+        return {"added": len(added), "unchanged": unchanged, "removed": len(stale_ids)}
+
+    def delete_source(self, source: str, user_id: int) -> int:
+        with self.transaction() as cur:
+            cur.execute(
+                "DELETE FROM documents WHERE user_id = %s AND metadata->>'source' = %s",
+                (user_id, source)
+            )
+            deleted = cur.rowcount
+            cur.execute("DELETE FROM sources WHERE user_id = %s AND source = %s", (user_id, source))
+        return deleted
+
+    def _refresh_source_catalog(self, cur, source: str, user_id: int, remaining: int):
+        if not remaining:
+            cur.execute("DELETE FROM sources WHERE user_id = %s AND source = %s", (user_id, source))
+            return
+        cur.execute(
+            "INSERT INTO sources (user_id, source, metadata, chunk_count, page_count, bytes, preview)"
+            + SOURCE_SUMMARY_SQL.format(where="user_id = %s AND metadata->>'source' = %s")
+            + """
+            ON CONFLICT (user_id, source) DO UPDATE SET
+                metadata = EXCLUDED.metadata,
+                chunk_count = EXCLUDED.chunk_count,
+                page_count = EXCLUDED.page_count,
+                bytes = EXCLUDED.bytes,
+                preview = EXCLUDED.preview,
+                ingested_at = CURRENT_TIMESTAMP
+            """,
+            (PREVIEW_CHARS, user_id, source)
+        )
+
+    def maintain_documents(self):
+        """Vacuum the documents table, and rebuild its vector indexes, once deletes leave enough dead rows."""
+        # VACUUM and REINDEX CONCURRENTLY must run outside a transaction and can take a while,
+        # so use a separate autocommit connection rather than the shared one
+        conn = self._connect()
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET statement_timeout = 0")
+                # Every worker runs this on the same schedule; only one does the work. The lock is
+                # held by this session and released when the connection closes.
+                cur.execute("SELECT pg_try_advisory_lock(hashtext('maintain_documents'))")
+                if not cur.fetchone()[0]:
+                    return {"vacuumed": False, "reindexed": [], "skipped": True}
+                cur.execute("""
+                    SELECT n_live_tup, n_dead_tup
+                    FROM pg_stat_user_tables
+                    WHERE relname = 'documents'
+                """)
+                row = cur.fetchone()
+                if not row:
+                    return {"vacuumed": False, "reindexed": []}
+                live, dead = row
+                if dead < max(VACUUM_MIN_DEAD_ROWS, VACUUM_DEAD_RATIO * live):
+                    return {"vacuumed": False, "reindexed": []}
+                
+                cur.execute("VACUUM (ANALYZE) documents")
+                cur.execute("""
+                    SELECT indexname
+                    FROM pg_indexes
+                    WHERE tablename = 'documents'
+                      AND (indexdef ILIKE '%USING hnsw%' OR indexdef ILIKE '%USING ivfflat%')
+                """)
+                indexes = [r[0] for r in cur.fetchall()]
+                for index in indexes:
+                    cur.execute(f'REINDEX INDEX CONCURRENTLY "{index}"')
+                print(f"Vacuumed documents ({dead} dead rows), reindexed {len(indexes)} vector index(es)")
+                return {"vacuumed": True, "reindexed": indexes}
+        finally:
+            conn.close()
+
+    def query(self, query_text: str, user_id: int, n_results: int = 5, with_embeddings: bool = False):
+        query_embedding = self.model.encode(query_text).tolist()
+        return self.search(query_embedding, user_id, n_results=n_results, with_embeddings=with_embeddings)
+
+    def search(
+        self,
+        query_embedding: List[float],
+        user_id: int,
+        n_results: int = 5,
+        with_embeddings: bool = False,
+        filters: Optional[Dict] = None,
+        min_similarity: Optional[float] = None
+    ):
+        if len(query_embedding) != self.dim:
+            raise ValueError(f"Expected a {self.dim}-dimensional embedding for {self.model_id}, got {len(query_embedding)}")
+        column = self.column
+        embedding_column = f", {column}::text" if with_embeddings else ""
+        
+        # $1 is the query vector, $2 the user, $3 the limit. Each combination of options
+        # is its own prepared statement.
+        # Rows not yet embedded with the active model are skipped rather than ranked
+        conditions = ["user_id = $2", f"{column} IS NOT NULL"]
+        params = [query_embedding, user_id, n_results]
+        variant = [column, "emb" if with_embeddings else ""]
+        if filters:
+            # Exact-match metadata filters, e.g. {"source": "a.pdf"}
+            params.append(json.dumps(filters))
+            conditions.append(f"metadata @> ${len(params)}::jsonb")
+            variant.append("filtered")
+        if min_similarity is not None:
+            params.append(1 - min_similarity)
+            conditions.append(f"{column} <=> $1::vector <= ${len(params)}")
+            variant.append("min")
+        sql = f"""
+            SELECT content, metadata, 1 - ({column} <=> $1::vector) as similarity{embedding_column}
+            FROM documents
+            WHERE {" AND ".join(conditions)}
+            ORDER BY {column} <=> $1::vector
+            LIMIT $3
+        """
+        name = "search_" + "_".join(v for v in variant if v)
+        
+        def run(cur):
+            self._execute_prepared(cur, name, sql, tuple(params), timeout_ms=DB_SEARCH_TIMEOUT_MS)
+            return self._format_results(cur.fetchall(), with_embeddings)
+        return self._read(name, run)
+
+    def query_many(self, query_texts: List[str], user_id: int, n_results: int = 5, with_embeddings: bool = False):
+        """Retrieve top-k for several queries with one encoder batch and one LATERAL join."""
+        query_embeddings = self.model.encode(query_texts)
+        vectors = [json.dumps(embedding) for embedding in query_embeddings.tolist()]
+        column = self.column
+        embedding_column = ", d.embedding::text" if with_embeddings else ""
+        
+        def run(cur):
+            self._execute(cur, "query_many", f"""
+                SELECT q.idx, d.content, d.metadata, 1 - (d.embedding <=> q.embedding) as similarity{embedding_column}
+                FROM unnest(%s::vector[]) WITH ORDINALITY AS q(embedding, idx)
+                CROSS JOIN LATERAL (
+                    SELECT content, metadata, {column} AS embedding
+                    FROM documents
+                    WHERE user_id = %s AND {column} IS NOT NULL
+                    ORDER BY {column} <=> q.embedding
+                    LIMIT %s
+                ) d
+                ORDER BY q.idx, similarity DESC
+            """, (vectors, user_id, n_results), timeout_ms=DB_SEARCH_TIMEOUT_MS)
+            
+            rows_by_query = [[] for _ in query_texts]
+            for row in cur.fetchall():
+                rows_by_query[row[0] - 1].append(row[1:])
+            return [self._format_results(rows, with_embeddings) for rows in rows_by_query]
+        return self._read("query_many", run)
+
+    def _format_results(self, rows, with_embeddings: bool):
+        results = {
+            "documents": [[row[0] for row in rows]],
+            "metadatas": [[row[1] for row in rows]],
+            "distances": [[1 - row[2] for row in rows]]
+        }
+        if with_embeddings:
+            results["embeddings"] = [[json.loads(row[3]) for row in rows]]
+        return results
+
+    def list_documents(self, user_id: int, limit: int = 100, cursor: Optional[str] = None):
         with self.conn.cursor() as cur:
-            # Get total unique documents (files)
-            cur.execute("SELECT count(DISTINCT metadata->>'source') FROM documents WHERE user_id = %s", (user_id,))
+            # Total unique documents (files), served from the catalog index
+            cur.execute("SELECT count(*) FROM sources WHERE user_id = %s", (user_id,))
             count = cur.fetchone()[0]
             
-            # Get unique documents by source
-            cur.execute("""
-                SELECT DISTINCT ON (metadata->>'source') 
-                    id, 
-                    metadata, 
-                    left(content, 200) 
-                FROM documents 
-                WHERE user_id = %s
-                LIMIT %s
-            """, (user_id, limit,))
+            # Newest first, keyset-paginated on (ingested_at, id)
+            if cursor:
+                ingested_at, last_id = decode_cursor(cursor)
+                cur.execute("""
+                    SELECT id, metadata, preview, chunk_count, page_count, bytes, ingested_at
+                    FROM sources
+                    WHERE user_id = %s AND (ingested_at, id) < (%s::timestamp, %s)
+                    ORDER BY ingested_at DESC, id DESC
+                    LIMIT %s
+                """, (user_id, ingested_at, last_id, limit + 1))
+            else:
+                cur.execute("""
+                    SELECT id, metadata, preview, chunk_count, page_count, bytes, ingested_at
+                    FROM sources
+                    WHERE user_id = %s
+                    ORDER BY ingested_at DESC, id DESC
+                    LIMIT %s
+                """, (user_id, limit + 1))
             
             rows = cur.fetchall()
             
+            next_cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = encode_cursor(rows[-1][6].isoformat(), rows[-1][0])
+            
             docs = []
             for row in rows:
                 docs.append({
                     "id": row[0],
                     "metadata": row[1],
-                    "preview": row[2] + "..."
+                    "preview": (row[2] or "") + "...",
+                    "chunk_count": row[3],
+                    "page_count": row[4],
+                    "bytes": row[5],
+                    "ingested_at": row[6].isoformat()
                 })
-            return {"count": count, "documents": docs}
+            return {"count": count, "documents": docs, "next_cursor": next_cursor}
 
     def save_chat(self, user_message: str, ai_message: str, user_id: int):
         with self.conn.cursor() as cur:
@@ -143,39 +627,129 @@ class RAGEngine:
                 VALUES (%s, %s, %s)
             """, (user_message, ai_message, user_id))
 
-    def get_chat_history(self, user_id: int, limit: int = 50):
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                SELECT id, user_message, ai_message, timestamp 
+    def save_chats(self, rows: List[tuple]):
+        """Insert many (user_message, ai_message, user_id) rows in one statement."""
+        with self.conn.cursor() as cur, self._timed("save_chats"):
+            execute_values(cur, """
+                INSERT INTO chat_history (user_message, ai_message, user_id)
+                VALUES %s
+            """, rows)
+
+    def get_chat_history(self, user_id: int, limit: int = 50, cursor: Optional[str] = None, preview: bool = False):
+        # $1 is the user and $2 the limit; each preview/cursor combination is its own prepared statement
+        params = [user_id, limit]
+        # Preview mode ships only the head of each AI message for list views
+        if preview:
+            columns = "id, user_message, left(ai_message, $3), timestamp, char_length(ai_message) > $3"
+            params.append(HISTORY_PREVIEW_CHARS)
+        else:
+            columns = "id, user_message, ai_message, timestamp"
+        
+        keyset = ""
+        if cursor:
+            timestamp, last_id = decode_cursor(cursor)
+            keyset = f"AND (timestamp, id) < (${len(params) + 1}::timestamp, ${len(params) + 2})"
+            params += [timestamp, last_id]
+        name = "chat_history" + ("_preview" if preview else "") + ("_after" if cursor else "")
+        
+        def run(cur):
+            self._execute_prepared(cur, name, f"""
+                SELECT {columns}
                 FROM chat_history 
-                WHERE user_id = %s
-                ORDER BY timestamp DESC 
-                LIMIT %s
-            """, (user_id, limit))
-            rows = cur.fetchall()
-            return [
-                {"id": row[0], "user": row[1], "ai": row[2], "timestamp": row[3].isoformat()} 
-                for row in rows
-            ]
+                WHERE user_id = $1 {keyset}
+                ORDER BY timestamp DESC, id DESC
+                LIMIT $2
+            """, tuple(params))
+            return cur.fetchall()
+        rows = self._read(name, run)
+        
+        history = []
+        for row in rows:
+            item = {"id": row[0], "user": row[1], "ai": row[2], "timestamp": row[3].isoformat()}
+            if preview:
+                item["truncated"] = bool(row[4])
+            history.append(item)
+        return history
+
+    def iter_chat_history(self, user_id: int, batch_size: int = 500):
+        # Walks the full history in keyset batches so exports never hold it all in memory
+        cursor = None
+        while True:
+            batch = self.get_chat_history(user_id, limit=batch_size, cursor=cursor)
+            yield from batch
+            if len(batch) < batch_size:
+                return
+            cursor = encode_cursor(batch[-1]["timestamp"], batch[-1]["id"])
 
     def get_chat_item(self, chat_id: int, user_id: int):
-        with self.conn.cursor() as cur:
-            cur.execute("""
+        def run(cur):
+            self._execute(cur, "get_chat_item", """
                 SELECT id, user_message, ai_message, timestamp
                 FROM chat_history
                 WHERE id = %s AND user_id = %s
             """, (chat_id, user_id))
+            return cur.fetchone()
+        row = self._read("get_chat_item", run)
+        if row:
+            return {"id": row[0], "user": row[1], "ai": row[2], "timestamp": row[3].isoformat()}
+        return None
+
+    def create_refine_session(self, prompt: str, user_id: int):
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO refine_sessions (user_id, current_prompt)
+                VALUES (%s, %s)
+                RETURNING id
+            """, (user_id, prompt))
+            return {"id": cur.fetchone()[0], "current_prompt": prompt, "summary": "", "turns": []}
+
+    def get_refine_session(self, session_id: int, user_id: int, recent_turns: int = 4):
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                SELECT id, current_prompt, summary
+                FROM refine_sessions
+                WHERE id = %s AND user_id = %s
+            """, (session_id, user_id))
             row = cur.fetchone()
-            if row:
-                return {"id": row[0], "user": row[1], "ai": row[2], "timestamp": row[3].isoformat()}
-            return None
+            if not row:
+                return None
+            cur.execute("""
+                SELECT role, content
+                FROM refine_turns
+                WHERE session_id = %s
+                ORDER BY id DESC
+                LIMIT %s
+            """, (session_id, recent_turns))
+            turns = [{"role": r[0], "content": r[1]} for r in reversed(cur.fetchall())]
+            return {"id": row[0], "current_prompt": row[1], "summary": row[2], "turns": turns}
+
+    def update_refine_session(self, session_id: int, prompt: str, summary: str, turns: List[tuple], user_id: int):
+        # One autocommit statement on the shared connection: the turns are only recorded if the update matched
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                WITH s AS (
+                    UPDATE refine_sessions
+                    SET current_prompt = %s, summary = %s, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = %s AND user_id = %s
+                    RETURNING id
+                )
+                INSERT INTO refine_turns (session_id, role, content)
+                SELECT s.id, t.role, t.content
+                FROM s, unnest(%s::text[], %s::text[]) WITH ORDINALITY AS t(role, content, n)
+                ORDER BY t.n
+            """, (prompt, summary, session_id, user_id, [role for role, _ in turns], [content for _, content in turns]))
 
     def keep_alive(self):
+        conn = self.conn
         try:
-            with self.conn.cursor() as cur:
+            with conn.cursor() as cur:
                 cur.execute("SELECT 1")
             print("Pinged DB to keep alive")
         except Exception as e:
-            print(f"Keep-alive ping failed: {e}")
+            print(f"Keep-alive ping failed: {e}, reconnecting")
+            try:
+                self._replace_connection(conn)
+            except Exception as reconnect_error:
+                print(f"Reconnect failed: {reconnect_error}")
 
 rag_engine = RAGEngine()
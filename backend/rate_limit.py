@@ -0,0 +1,206 @@
+import os
+import math
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limit exceeded, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+class CostExceedsLimit(Exception):
+    def __init__(self, cost: float, capacity: float):
+        super().__init__(f"This request costs {cost:g} requests but the limit allows at most {capacity:g} at once")
+        self.cost = cost
+        self.capacity = capacity
+
+class Overloaded(Exception):
+    def __init__(self, stage: str, retry_after: float = 1.0):
+        super().__init__(f"The {stage} stage is at capacity, please retry shortly")
+        self.retry_after = retry_after
+
+def parse_limit(spec: str):
+    """Parse "<requests>/<seconds>" into a (capacity, refill rate per second) bucket."""
+    requests, seconds = spec.split("/")
+    capacity = float(requests)
+    return capacity, capacity / float(seconds)
+
+class MemoryRateLimitStore:
+    """Token buckets held in this process; enough for a single worker."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key: str, capacity: float, rate: float, cost: float = 1):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+        return allowed, tokens
+
+class PostgresRateLimitStore:
+    """Token buckets in an unlogged table, shared by every worker using the same database."""
+
+    def __init__(self, engine):
+        # Hold the engine rather than its connection, which is replaced after a worker forks
+        self.engine = engine
+        with self.engine.conn.cursor() as cur:
+            cur.execute("""
+                CREATE UNLOGGED TABLE IF NOT EXISTS rate_limits (
+                    key TEXT PRIMARY KEY,
+                    tokens DOUBLE PRECISION NOT NULL,
+                    updated_at DOUBLE PRECISION NOT NULL,
+                    allowed BOOLEAN NOT NULL
+                )
+            """)
+
+    def consume(self, key: str, capacity: float, rate: float, cost: float = 1):
+        # Refill, test and debit in one atomic upsert
+        with self.engine.conn.cursor() as cur:
+            cur.execute("""
+                WITH now AS (SELECT extract(epoch FROM clock_timestamp())::double precision AS ts)
+                INSERT INTO rate_limits AS b (key, tokens, updated_at, allowed)
+                SELECT %(key)s, %(capacity)s - %(cost)s, now.ts, %(capacity)s >= %(cost)s FROM now
+                ON CONFLICT (key) DO UPDATE SET
+                    allowed = least(%(capacity)s, b.tokens + (EXCLUDED.updated_at - b.updated_at) * %(rate)s) >= %(cost)s,
+                    tokens = least(%(capacity)s, b.tokens + (EXCLUDED.updated_at - b.updated_at) * %(rate)s)
+                        - CASE WHEN least(%(capacity)s, b.tokens + (EXCLUDED.updated_at - b.updated_at) * %(rate)s) >= %(cost)s
+                               THEN %(cost)s ELSE 0 END,
+                    updated_at = EXCLUDED.updated_at
+                RETURNING allowed, tokens
+            """, {"key": key, "capacity": capacity, "rate": rate, "cost": cost})
+            allowed, tokens = cur.fetchone()
+        return allowed, tokens
+
+class RateLimiter:
+    def __init__(self, store, limits: dict):
+        self.store = store
+        self.limits = limits
+
+    def check(self, user_id: int, endpoint_class: str, cost: float = 1):
+        capacity, rate = self.limits[endpoint_class]
+        # A request costing more than the whole bucket could never pass; waiting would not help either
+        if cost > capacity:
+            raise CostExceedsLimit(cost, capacity)
+        allowed, tokens = self.store.consume(f"{endpoint_class}:{user_id}", capacity, rate, cost)
+        if not allowed:
+            raise RateLimited(retry_after=math.ceil((cost - tokens) / rate))
+
+class _Waiter:
+    def __init__(self, loop=None):
+        self.granted = False
+        self.loop = loop
+        self.event = None if loop else threading.Event()
+        self.future = loop.create_future() if loop else None
+
+    def grant(self):
+        self.granted = True
+        if self.event:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(None))
+
+class AdmissionGate:
+    """Caps concurrent work in a stage, letting a bounded number of callers queue for a slot.
+
+    Callers beyond `max_waiting`, or who wait longer than `timeout`, get `Overloaded`.
+    A released slot goes straight to the longest waiting caller. Async callers wait on
+    a future, so a long queue never ties up threadpool workers.
+    """
+
+    def __init__(self, name: str, max_active: int, max_waiting: int, timeout: float):
+        self.name = name
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._waiters = deque()
+        self._active = 0
+        self._rejected = 0
+
+    def _try_acquire(self, waiter_factory):
+        # Returns None when a slot was taken right away, otherwise the queued waiter
+        with self._lock:
+            if self._active < self.max_active and not self._waiters:
+                self._active += 1
+                return None
+            if len(self._waiters) >= self.max_waiting:
+                self._rejected += 1
+                raise Overloaded(self.name)
+            waiter = waiter_factory()
+            self._waiters.append(waiter)
+            return waiter
+
+    def _give_up(self, waiter, rejected: bool = True) -> bool:
+        """Leave the queue; False if a slot was handed over in the meantime."""
+        with self._lock:
+            if waiter.granted:
+                return False
+            self._waiters.remove(waiter)
+            self._rejected += rejected
+            return True
+
+    def acquire(self):
+        waiter = self._try_acquire(_Waiter)
+        if waiter and not waiter.event.wait(self.timeout) and self._give_up(waiter):
+            raise Overloaded(self.name)
+
+    async def async_acquire(self):
+        loop = asyncio.get_running_loop()
+        waiter = self._try_acquire(lambda: _Waiter(loop))
+        if not waiter:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.timeout)
+        except asyncio.TimeoutError:
+            if self._give_up(waiter):
+                raise Overloaded(self.name)
+        except asyncio.CancelledError:
+            # The caller went away; give back a slot that was already handed over
+            if not self._give_up(waiter, rejected=False):
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                # The slot passes to the next waiter, so the active count stays the same
+                self._waiters.popleft().grant()
+            else:
+                self._active -= 1
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def async_slot(self):
+        await self.async_acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"active": self._active, "waiting": len(self._waiters), "rejected": self._rejected}
+
+def create_rate_limit_store(engine=None):
+    backend = os.getenv("RATE_LIMIT_BACKEND", "memory")
+    if backend == "postgres":
+        return PostgresRateLimitStore(engine)
+    if backend != "memory":
+        raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {backend}")
+    return MemoryRateLimitStore()
@@ -0,0 +1,33 @@
+import unittest
+
+from context import count_tokens, trim_to_sentences, mmr_order, pack_context
+
+class TestContextPacking(unittest.TestCase):
+    def test_trim_to_sentences_keeps_whole_sentences(self):
+        text = "First sentence here. Second sentence is a bit longer! Third?"
+        trimmed = trim_to_sentences(text, count_tokens("First sentence here.") + 2)
+        self.assertEqual(trimmed, "First sentence here.")
+        self.assertEqual(trim_to_sentences(text, 1), "")
+
+    def test_mmr_drops_near_duplicates(self):
+        relevance = [0.9, 0.89, 0.5]
+        embeddings = [[1.0, 0.0], [1.0, 0.001], [0.0, 1.0]]
+        self.assertEqual(mmr_order(relevance, embeddings), [0, 2])
+
+    def test_pack_context_respects_budget(self):
+        long_chunk = "A short lead sentence. " + "filler " * 400
+        results = {
+            "documents": [["Top chunk.", long_chunk]],
+            "metadatas": [[{"source": "a.pdf"}, {"source": "b.pdf"}]],
+            "distances": [[0.1, 0.2]],
+            "embeddings": [[[1.0, 0.0], [0.0, 1.0]]],
+        }
+
+        packed = pack_context(results, budget=100)
+
+        self.assertEqual(packed["sources"], ["a.pdf", "b.pdf"])
+        self.assertEqual(packed["chunks"][1], "A short lead sentence.")
+        self.assertLessEqual(packed["tokens"], 100)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+from unittest.mock import MagicMock
+
+from history_writer import HistoryWriter
+
+class TestHistoryWriter(unittest.TestCase):
+    def test_flushes_in_batches_and_drains_on_stop(self):
+        engine = MagicMock()
+        writer = HistoryWriter(engine, max_queue=100, batch_size=2, flush_interval=60)
+        for i in range(5):
+            writer.enqueue(f"user {i}", f"ai {i}", 1)
+
+        writer.start()
+        writer.stop()
+
+        batches = [c[0][0] for c in engine.save_chats.call_args_list]
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+        self.assertEqual(batches[0][0], ("user 0", "ai 0", 1))
+        stats = writer.stats()
+        self.assertEqual(stats["written"], 5)
+        self.assertEqual(stats["queue_depth"], 0)
+
+    def test_drops_when_queue_is_full(self):
+        writer = HistoryWriter(MagicMock(), max_queue=1)
+        self.assertTrue(writer.enqueue("a", "b", 1))
+        self.assertFalse(writer.enqueue("c", "d", 1))
+        self.assertEqual(writer.stats()["dropped"], 1)
+
+    def test_failed_flush_is_counted(self):
+        engine = MagicMock()
+        engine.save_chats.side_effect = RuntimeError("db down")
+        writer = HistoryWriter(engine, batch_size=10, flush_interval=60)
+        writer.enqueue("a", "b", 1)
+
+        writer.start()
+        writer.stop()
+
+        self.assertEqual(writer.stats()["failed"], 1)
+
+if __name__ == "__main__":
+    unittest.main()
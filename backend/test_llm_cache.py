@@ -0,0 +1,59 @@
+import sys
+from unittest.mock import MagicMock, patch
+import unittest
+import os
+import threading
+import time
+
+# Mock modules
+sys.modules["google"] = MagicMock()
+sys.modules["google.generativeai"] = MagicMock()
+
+sys.path.append(os.getcwd())
+from llm_cache import ModelCache, UnknownModel
+
+class TestModelCache(unittest.TestCase):
+    def test_unknown_models_are_rejected(self):
+        cache = ModelCache()
+        with patch.object(cache, "_build") as build:
+            with self.assertRaises(UnknownModel):
+                cache.get("my-own-model", "Be brief.")
+        build.assert_not_called()
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = ModelCache(max_entries=2)
+        with patch.object(cache, "_build", side_effect=lambda *args: (MagicMock(), None)) as build:
+            first = cache.get("gemini-1.5-flash", "one")
+            cache.get("gemini-1.5-flash", "two")
+            self.assertIs(cache.get("gemini-1.5-flash", "one"), first)
+            cache.get("gemini-1.5-flash", "three")  # evicts "two"
+            self.assertIs(cache.get("gemini-1.5-flash", "one"), first)
+            cache.get("gemini-1.5-flash", "two")
+
+        self.assertEqual(build.call_count, 4)
+        self.assertEqual(len(cache._models), 2)
+
+    def test_concurrent_misses_build_once_without_blocking_other_entries(self):
+        cache = ModelCache()
+        release = threading.Event()
+
+        def slow_build(model_name, instruction, now):
+            if instruction == "slow":
+                release.wait(5)
+            return MagicMock(), None
+
+        with patch.object(cache, "_build", side_effect=slow_build) as build:
+            threads = [threading.Thread(target=cache.get, args=("gemini-1.5-flash", "slow")) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.05)
+            # Another entry is served while the slow one is still being built
+            cache.get("gemini-1.5-flash", "fast")
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(build.call_count, 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+import asyncio
+import io
+import json
+import unittest
+
+import httpx
+from fastapi.testclient import TestClient
+from pypdf import PdfReader
+from random import Random
+
+from loadtest.fixtures import make_pdf
+from loadtest.runner import Recorder, VirtualUser, Workload, classify, find_bottleneck, parse_mix, saturation_point
+from loadtest.stub_gemini import LatencyProfile, create_app
+
+def metrics(llm_rejected=0, llm_waiting=0, search_p95=5.0, timeouts=0, queue_depth=0):
+    return {
+        "admission": {
+            "llm": {"active": 16, "waiting": llm_waiting, "rejected": llm_rejected},
+            "ingest": {"active": 0, "waiting": 0, "rejected": 0},
+        },
+        "history_writer": {"queue_depth": queue_depth, "dropped": 0},
+        "db": {"search_embedding": {"p95_ms": search_p95, "timeouts": timeouts}},
+    }
+
+def stage(samples, p95_ms=100.0):
+    recorder = Recorder()
+    for _ in range(20):
+        recorder.record("generate", "ok", p95_ms / 1000)
+    return {"offered_rps": 4, "duration": 10, "elapsed": 10, "operations": recorder.summary(10), "metrics": samples}
+
+class TestLoadTest(unittest.TestCase):
+    def test_parse_mix(self):
+        self.assertEqual(parse_mix("generate=4, history=1"), {"generate": 4.0, "history": 1.0})
+        with self.assertRaises(ValueError):
+            parse_mix("generate=4,upload=1")
+
+    def test_classify_tells_overload_from_rate_limit(self):
+        overloaded = httpx.Response(429, json={"detail": "The llm stage is at capacity, please retry shortly"})
+        limited = httpx.Response(429, json={"detail": "Rate limit exceeded, retry in 3.0s"})
+        soft_failure = httpx.Response(200, json={"response": "Error generating prompt. Please try again."})
+        self.assertEqual(classify(overloaded), "overloaded")
+        self.assertEqual(classify(limited), "rate_limited")
+        self.assertEqual(classify(soft_failure), "app_error")
+        self.assertEqual(classify(httpx.Response(200, json=[])), "ok")
+
+    def test_recorder_percentiles_and_error_rate(self):
+        recorder = Recorder()
+        for ms in range(1, 101):
+            recorder.record("history", "ok", ms / 1000)
+        recorder.record("history", "timeout", 60)
+
+        summary = recorder.summary(elapsed=10)["history"]
+        self.assertEqual((summary["sent"], summary["ok"]), (101, 100))
+        self.assertEqual(summary["p50_ms"], 51.0)
+        self.assertEqual(summary["p99_ms"], 100.0)
+        self.assertEqual(summary["errors"], {"timeout": 1})
+
+    def test_bottleneck_prefers_server_signals(self):
+        gate = find_bottleneck(stage([metrics(), metrics(llm_rejected=5, llm_waiting=64)]))
+        self.assertEqual(gate["stage"], "llm admission gate")
+
+        database = find_bottleneck(stage([metrics(), metrics(search_p95=900.0, timeouts=2)]))
+        self.assertEqual(database["stage"], "database")
+        self.assertIn("search_embedding", database["signals"][0])
+
+    def test_bottleneck_falls_back_to_latency_growth(self):
+        baseline = stage([metrics(), metrics()], p95_ms=100.0)
+        loaded = stage([metrics(), metrics()], p95_ms=450.0)
+        self.assertEqual(find_bottleneck(loaded, baseline)["stage"], "retrieval (embedding + vector search)")
+        self.assertIsNone(find_bottleneck(baseline, baseline)["stage"])
+
+    def test_saturation_point_is_first_stage_falling_behind(self):
+        keeping_up = stage([])
+        falling_behind = dict(stage([]), offered_rps=16, elapsed=25)
+        self.assertEqual(saturation_point([keeping_up, falling_behind]), 16)
+        self.assertIsNone(saturation_point([keeping_up]))
+
+    def test_refine_drives_the_endpoint_the_frontend_uses(self):
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            body = json.loads(request.content)
+            return httpx.Response(200, json={"refined_prompt": body["current_prompt"] + "!", "ai_response": "Done"})
+
+        async def refine_twice():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://test") as client:
+                workload = Workload(client, [], {"refine": 1}, "pw", Random(1))
+                user = VirtualUser("a@example.com")
+                await workload.refine(user)
+                await workload.refine(user)
+                return user
+
+        user = asyncio.run(refine_twice())
+        self.assertEqual([r.url.path for r in requests], ["/api/refine", "/api/refine"])
+        second = json.loads(requests[1].content)
+        self.assertEqual([m["role"] for m in second["chat_history"]], ["user", "ai", "user"])
+        self.assertTrue(user.prompt.endswith("!!"))
+
+    def test_generated_pdf_is_extractable(self):
+        reader = PdfReader(io.BytesIO(make_pdf(["First page (draft)", "Second page"])))
+        self.assertEqual(len(reader.pages), 2)
+        self.assertIn("First page (draft)", reader.pages[0].extract_text())
+
+    def test_stub_answers_json_mode_with_usage(self):
+        client = TestClient(create_app(LatencyProfile(median_ms=1, ms_per_token=0, seed=1)))
+        response = client.post("/v1beta/models/gemini-1.5-flash:generateContent", json={
+            "contents": [{"role": "user", "parts": [{"text": "Make it shorter"}]}],
+            "generationConfig": {"responseMimeType": "application/json"},
+        })
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        refined = json.loads(body["candidates"][0]["content"]["parts"][0]["text"])
+        self.assertIn("refined_prompt", refined)
+        self.assertGreater(body["usageMetadata"]["candidatesTokenCount"], 0)
+
+        failing = TestClient(create_app(LatencyProfile(median_ms=1, ms_per_token=0, error_rate=1.0)))
+        self.assertEqual(failing.post("/v1beta/models/m:generateContent", json={"contents": []}).status_code, 503)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+from context import count_tokens
+from prompt_templates import GENERATION_FIELDS, PromptTemplate, TemplateRegistry, prompt_registry
+
+class TestPromptTemplates(unittest.TestCase):
+    def test_modes_use_their_own_system_instruction(self):
+        engineer = prompt_registry.get("engineer")
+        critic = prompt_registry.get("critic")
+        direct = prompt_registry.get("direct")
+
+        self.assertIn("Critical Reviewer", critic.system_instruction)
+        self.assertIn("Knowledge Base Assistant", direct.system_instruction)
+        self.assertEqual(len({engineer.system_instruction, critic.system_instruction, direct.system_instruction}), 3)
+        # The dynamic part carries the request only, never the instructions
+        rendered = critic.render(query="Summarize Q3", context="Revenue grew.")
+        self.assertIn("USER REQUEST: Summarize Q3", rendered)
+        self.assertNotIn("Critical Reviewer", rendered)
+
+    def test_versions_and_fallback(self):
+        self.assertEqual(prompt_registry.get("engineer").key, "engineer@v2")
+        self.assertEqual(prompt_registry.get("engineer", 1).key, "engineer@v1")
+        self.assertEqual(prompt_registry.get("unknown-mode").name, "engineer")
+        with self.assertRaises(KeyError):
+            prompt_registry.get("critic", 99)
+
+    def test_generation_lookup_rejects_other_templates(self):
+        self.assertEqual(prompt_registry.get("direct", fields=GENERATION_FIELDS).name, "direct")
+        with self.assertRaises(KeyError):
+            prompt_registry.get("refine_session", fields=GENERATION_FIELDS)
+
+    def test_token_counts_are_precomputed(self):
+        template = PromptTemplate("t", 1, "Be brief.", "Q: {query}", ("query",))
+        self.assertEqual(template.system_tokens, count_tokens("Be brief."))
+        self.assertEqual(template.request_overhead_tokens, count_tokens("Q: "))
+
+    def test_invalid_templates_are_rejected_at_load(self):
+        with self.assertRaises(ValueError):
+            PromptTemplate("t", 1, "Be brief.", "Q: {question}", ("query",))
+        registry = TemplateRegistry(default="t")
+        registry.register(PromptTemplate("t", 1, "Be brief.", "Q: {query}", ("query",)))
+        with self.assertRaises(ValueError):
+            registry.register(PromptTemplate("t", 1, "Be briefer.", "Q: {query}", ("query",)))
+
+if __name__ == "__main__":
+    unittest.main()
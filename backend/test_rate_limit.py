@@ -0,0 +1,91 @@
+import asyncio
+import threading
+import unittest
+from unittest.mock import patch
+
+from rate_limit import RateLimiter, MemoryRateLimitStore, AdmissionGate, RateLimited, Overloaded, CostExceedsLimit, parse_limit
+
+class TestRateLimiter(unittest.TestCase):
+    def test_bucket_allows_burst_then_refills(self):
+        limiter = RateLimiter(MemoryRateLimitStore(), {"generate": parse_limit("2/10")})
+        with patch("rate_limit.time.monotonic", return_value=100.0):
+            limiter.check(1, "generate")
+            limiter.check(1, "generate")
+            with self.assertRaises(RateLimited) as ctx:
+                limiter.check(1, "generate")
+            self.assertEqual(ctx.exception.retry_after, 5)
+            # Buckets are per user
+            limiter.check(2, "generate")
+        with patch("rate_limit.time.monotonic", return_value=105.0):
+            limiter.check(1, "generate")
+
+    def test_request_costing_more_than_bucket_is_rejected(self):
+        limiter = RateLimiter(MemoryRateLimitStore(), {"generate": parse_limit("30/60")})
+        with self.assertRaises(CostExceedsLimit):
+            limiter.check(1, "generate", cost=256)
+        # Nothing was charged for the rejected request
+        limiter.check(1, "generate", cost=30)
+
+class TestAdmissionGate(unittest.TestCase):
+    def test_rejects_beyond_queue(self):
+        gate = AdmissionGate("llm", max_active=1, max_waiting=0, timeout=1)
+        with gate.slot():
+            with self.assertRaises(Overloaded):
+                gate.acquire()
+        self.assertEqual(gate.stats(), {"active": 0, "waiting": 0, "rejected": 1})
+
+    def test_queued_caller_gets_released_slot(self):
+        gate = AdmissionGate("ingest", max_active=1, max_waiting=1, timeout=5)
+        gate.acquire()
+        acquired = threading.Event()
+
+        def waiter():
+            with gate.slot():
+                acquired.set()
+
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        self.assertFalse(acquired.wait(0.05))
+        gate.release()
+        thread.join(1)
+        self.assertTrue(acquired.is_set())
+
+    def test_async_waiters_queue_without_threads(self):
+        gate = AdmissionGate("llm", max_active=1, max_waiting=100, timeout=5)
+
+        async def scenario():
+            order = []
+            threads_before = threading.active_count()
+
+            async def call(i):
+                async with gate.async_slot():
+                    order.append(i)
+                    await asyncio.sleep(0)
+
+            tasks = [asyncio.create_task(call(i)) for i in range(50)]
+            await asyncio.sleep(0)
+            self.assertEqual(gate.stats()["waiting"], 49)
+            self.assertEqual(threading.active_count(), threads_before)
+            await asyncio.gather(*tasks)
+            return order
+
+        self.assertEqual(asyncio.run(scenario()), list(range(50)))
+        self.assertEqual(gate.stats(), {"active": 0, "waiting": 0, "rejected": 0})
+
+    def test_cancelled_async_waiter_leaves_queue(self):
+        gate = AdmissionGate("llm", max_active=1, max_waiting=1, timeout=5)
+
+        async def scenario():
+            gate.acquire()
+            waiter = asyncio.create_task(gate.async_acquire())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+            gate.release()
+
+        asyncio.run(scenario())
+        self.assertEqual(gate.stats(), {"active": 0, "waiting": 0, "rejected": 0})
+
+if __name__ == "__main__":
+    unittest.main()